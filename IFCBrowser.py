@@ -3,19 +3,29 @@ import os
 import json
 import ifcopenshell
 import time
+import bisect
+import threading
+import multiprocessing
 
 from exporter.exporter_view   import ExporterWindow
-from db                       import DBWorker, SqlEntityTableModel
-from options                  import OptionsDialog
+from db                       import (DBWorker, SqlEntityTableModel, STEP_ID_INDEX, STAGE_ROWS, PAGE_SIZE, CACHE_PAGES, RESULT_CACHE_MB,
+                                      INDEX_PROPERTIES, LOG_CACHE_STATS, type_stats,
+                                      inverse_references, reference_count, forward_references, forward_count, ReferenceWorker,
+                                      EntitySummaries, instance_line)
+from options                  import OptionsDialog, load_config, save_config_value
+from cache                    import entity_cache
+from step_index               import StepIndex
+from step_model               import (StepModel, RawEntity, ENTITY_TYPES, AggregateAttribute, attribute_spans,
+                                      parse_value)
+from reference_tree           import ReferenceTreeModel
 
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QTreeView, QTableView, QHBoxLayout, QVBoxLayout, QWidget,
     QToolBar, QMessageBox, QFileDialog, QMenu, QSplitter, QAbstractItemView, QHeaderView,
     QProgressBar, QStackedLayout, QSizePolicy, QDockWidget, QScrollArea
 )
-from PySide6.QtGui  import QAction, QStandardItemModel, QStandardItem, QFont, QFontDatabase
-from PySide6.QtCore import Qt, QThread, Signal, Slot, QTimer, QTranslator
-from collections import defaultdict
+from PySide6.QtGui  import QAction, QFont, QFontDatabase
+from PySide6.QtCore import Qt, QThread, Signal, Slot, QTimer, QTranslator, QCoreApplication
 
 # Translation imports
 from tui import (language_manager,
@@ -25,7 +35,7 @@ from tui import (language_manager,
 from strings import (
     MAIN_TOOLBAR_ACTION_KEYS, MAIN_TOOLBAR_TOOLTIP_KEYS, CONTEXT_MENU_ACTION_KEYS,
     FILE_MENU_ACTION_KEYS, FILE_MENU_KEY, RECENT_FILES_MENU_KEY, MAIN_STATUS_LABEL_KEYS, ROW_COUNT_KEY,
-    BUILDING_INDEX_KEY, FILTER_WIDGET_KEYS
+    FILTER_WIDGET_KEYS, LOAD_STAGE_KEYS, FILTERING_KEY
 )
 
 from options        import CONFIG_PATH
@@ -35,19 +45,100 @@ from ui import *
 
 # TODO: Clearer labels for the main 3 views for ease of use
 
-# This simple worker takes in a line from the main thread and executes it in the background
-# It is used to execute ifcopenshell.open(file)
-# Large files can take some time to open so open them in the background and show a spinner in the meantime
-class SimpleIFCWorker(QThread):
+FILTER_DEBOUNCE_MS = 300 # Time since the last keystroke in the filter bar before filtering
+SELECTION_DELAY_MS = 80  # Time the current row has to stay put before the reference trees show it
+INLINE_LIST_LENGTH = 16  # Lists up to this long are shown on the row of their attribute in the right view
+STAGE_OPEN = 0 # The stages after opening the file are run by DBWorker
+OPEN_SECONDS_PER_MB = 0.1 # Initial guess for how long ifcopenshell.open takes. Replaced by the measured speed after every open
+PROGRESS_INTERVAL = 0.1   # Seconds between progress updates while ifcopenshell.open runs
+
+# The OpenIFCWorker class opens an IFC file in the background and reports its progress.
+# ifcopenshell.open is a single call without progress updates so the progress is estimated from the
+# size of the file and the speed of the previous opens while StepIndex scans the same file alongside it.
+# In browse mode the StepIndex scan is the whole open so its byte progress is reported directly.
+# indexed emits a StepModel as soon as the scan is done so the entity table can be filled while ifcopenshell is still parsing.
+# cancel() stops the scan right away. ifcopenshell.open itself cannot be interrupted, so it is left to
+# finish in a daemon thread and its result is dropped as soon as it returns instead of being kept in memory.
+# finished emits (model, step_index) or an error message, cancelled is emitted instead when cancel() was called.
+class OpenIFCWorker(QThread):
     progress = Signal(int)
+    indexed = Signal(object)
     finished = Signal(object)
-    def __init__(self, task_fn):
+    cancelled = Signal()
+
+    def __init__(self, file_path, browse=False, index=True):
         super().__init__()
-        self.task_fn = task_fn
+        self.file_path = file_path
+        self.browse = browse
+        self.index = index # False skips the StepIndex when only the model is needed
+
+    def cancel(self):
+        self.requestInterruption()
 
     def run(self):
-        result = self.task_fn()
-        self.finished.emit(result)
+        try:
+            result = self.open_browse() if self.browse else self.open_full()
+        except Exception as e:
+            result = f"Error: Failed to open {os.path.basename(self.file_path)}\n{e}"
+
+        if result is None:
+            self.cancelled.emit()
+        else:
+            self.finished.emit(result)
+
+    def open_browse(self):
+        step_index = StepIndex(self.file_path).build(progress_callback=self.progress.emit,
+                                                     should_stop=self.isInterruptionRequested)
+        if step_index is None:
+            return None
+        step_model = StepModel(step_index)
+        self.indexed.emit(step_model)
+        return step_model, step_index
+
+    def open_full(self):
+        size_mb = os.path.getsize(self.file_path) / 1024 ** 2
+        expected_seconds = max(size_mb * load_config().get("open_seconds_per_mb", OPEN_SECONDS_PER_MB), PROGRESS_INTERVAL)
+
+        result = {}
+        def open_model(file_path):
+            try:
+                result["model"] = ifcopenshell.open(file_path)
+            except Exception as e:
+                result["error"] = e
+
+        # Index the original step lines while ifcopenshell opens the file
+        def build_index(file_path):
+            try:
+                result["step_index"] = StepIndex(file_path).build(should_stop=self.isInterruptionRequested)
+            except Exception as e: # ifcopenshell can still open the file so only the pipeline is skipped
+                print(f"Unable to index {file_path}\n{e}")
+                return
+            if result["step_index"] and not self.isInterruptionRequested():
+                self.indexed.emit(StepModel(result["step_index"]))
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=open_model, args=(self.file_path,), daemon=True)]
+        if self.index:
+            threads.append(threading.Thread(target=build_index, args=(self.file_path,), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        while any(thread.is_alive() for thread in threads) and not self.isInterruptionRequested():
+            self.progress.emit(min(99, int((time.perf_counter() - start) / expected_seconds * 100)))
+            next(thread for thread in threads if thread.is_alive()).join(PROGRESS_INTERVAL)
+
+        step_index = result.get("step_index")
+        if self.isInterruptionRequested():
+            if step_index:
+                step_index.close()
+            return None
+        if "error" in result:
+            raise result["error"]
+
+        if size_mb >= 1: # Tiny files are dominated by overhead and would spoil the estimate
+            save_config_value("open_seconds_per_mb", (time.perf_counter() - start) / size_mb)
+        self.progress.emit(100)
+        return result["model"], step_index
    
 # Main window consisting of three main views
 # The middle view connects to an SQLite database and displays entities from the IFC file
@@ -60,6 +151,14 @@ class IfcViewer(QMainWindow):
         language_manager.language_changed.connect(self.change_language) # Connect to the language manager in ui.py
 
         self.row_count = 0 # Count the number of rows displayed in the middle view
+        self.step_index = None # Locations of the original step lines in the file
+        self.step_model = None # Reads entities from the step lines until ifcopenshell has opened the file
+        self.entity_summaries = None # Labels of the reference trees read from the database
+        self.pending_loads = set() # Parts of the current load that have not finished yet
+        self.stage_times = {} # Seconds taken by each stage of the current load
+        self.type_stats = {} # {Ifc Type: (count, step line bytes)}
+        self.cancelled_workers = [] # Cancelled workers are kept until their threads end
+        self.pending_selection = None # (STEP ID, from the middle view) waiting for selection_timer
 
         self.setWindowTitle("IFC Viewer")
         self.file_path = ifc_file
@@ -76,6 +175,12 @@ class IfcViewer(QMainWindow):
         self.add_main_view()
         self.add_stats_panel()
 
+        # Holding an arrow key moves the current row faster than the trees can follow, so only the row it stops on is shown
+        self.selection_timer = QTimer()
+        self.selection_timer.setSingleShot(True)
+        self.selection_timer.setInterval(SELECTION_DELAY_MS)
+        self.selection_timer.timeout.connect(self.show_selection)
+
         # Loading spinner
         self.spinner_frames = ["|", "/", "-", "\\"]
         self.current_frame = 0
@@ -116,13 +221,17 @@ class IfcViewer(QMainWindow):
 
     def add_left_view(self):
         self.left_view = QTreeView()
-        self.left_model = QStandardItemModel()
-        self.left_model.setHorizontalHeaderLabels(['References -> Entity'])
+        self.left_model = ReferenceTreeModel('References -> Entity', self.inverse_reference_ids, self.inverse_reference_count,
+                                             self.inverse_tree_label, prefetch=self.prefetch_summaries,
+                                             worker=self.inverse_reference_worker, ready=self.references_ready, parent=self)
         self.left_view.setModel(self.left_model)
+        self.left_view.setUniformRowHeights(True) # Only the labels of the rows on screen are made
         self.left_view.setContextMenuPolicy(Qt.CustomContextMenu)
         self.left_view.customContextMenuRequested.connect(lambda pos, v=self.left_view: self.show_context_menu(pos, v))
 
-        self.left_view.expanded.connect(self.lazy_load_inverse_references)
+        # The references of an entity are read when it is expanded and dropped when it is collapsed
+        self.left_view.collapsed.connect(self.left_model.release)
+        self.left_view.clicked.connect(self.left_model.load_more)
 
         # Update the views when selecting an item in the middle or left views
         self.left_view.selectionModel().currentChanged.connect(self.handle_entity_selection)
@@ -154,13 +263,16 @@ class IfcViewer(QMainWindow):
    
     def add_right_view(self):
         self.right_view = QTreeView()
-        self.right_model = QStandardItemModel()
-        self.right_model.setHorizontalHeaderLabels(['Entity <- Referenced By'])
+        self.right_model = ReferenceTreeModel('Entity <- Referenced By', self.forward_reference_ids, self.forward_reference_count,
+                                              self.forward_tree_label, attributes=self.attribute_rows,
+                                              prefetch=self.prefetch_summaries, parent=self)
         self.right_view.setModel(self.right_model)
+        self.right_view.setUniformRowHeights(True)
         self.right_view.setContextMenuPolicy(Qt.CustomContextMenu)
         self.right_view.customContextMenuRequested.connect(lambda pos, v=self.right_view: self.show_context_menu(pos, v))
 
-        self.right_view.expanded.connect(self.lazy_load_forward_references)
+        self.right_view.collapsed.connect(self.right_model.release)
+        self.right_view.clicked.connect(self.right_model.load_more)
 
     def add_toolbar(self):
         self.toolbar = QToolBar("Main Toolbar")
@@ -171,6 +283,7 @@ class IfcViewer(QMainWindow):
         main_toolbar_actions = [
             self.open_ifc_file,
             self.start_load_db_task,
+            self.cancel_loading,
             self.show_assemblies_exporter,
             self.show_phases_exporter,
             self.show_options_window
@@ -215,7 +328,7 @@ class IfcViewer(QMainWindow):
         file_menu = self.menubar.addMenu(FILE_MENU_KEY)
 
         file_menu_actions = [
-            self.open_ifc_file, open_new_ifc_viewer
+            self.open_ifc_file, self.browse_ifc_file, open_new_ifc_viewer
         ]
 
         for label, handler in zip(
@@ -230,8 +343,15 @@ class IfcViewer(QMainWindow):
 
     def add_filter_bar(self):
         # "Filter Entities..."
-        self.filter_bar = TLineEdit(FILTER_WIDGET_KEYS[0], self, context="Filter Widget")
-        self.filter_bar.textChanged.connect(self.apply_filter)
+        self.filter_bar = TLineEdit(FILTER_WIDGET_KEYS[0], FILTER_WIDGET_KEYS[2], context="Filter Widget", parent=self)
+
+        # Wait until the user stops typing before filtering
+        self.filter_timer = QTimer()
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DEBOUNCE_MS)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.filter_bar.textChanged.connect(self.filter_timer.start)
+        self.filter_bar.returnPressed.connect(self.apply_filter)
     
     def add_filter_button(self):
         # "Filter"
@@ -239,9 +359,17 @@ class IfcViewer(QMainWindow):
         self.filter_button.clicked.connect(self.apply_filter)
 
     def apply_filter(self):
+        self.filter_timer.stop()
+        if not self.middle_model:
+            return
         filter_term = self.filter_bar.text()
         self.middle_model.set_filter(filter_term)
 
+    # Show that the rows are being filtered until the new row count arrives
+    def filtering_started(self):
+        # "Filtering..."
+        self.row_count_label.setText(FILTERING_KEY)
+
     def add_count_and_progress_bar(self):
         self.row_count_bar_stack_widget = QWidget()
         self.row_count_bar_stack_widget.setMaximumHeight(25)
@@ -280,10 +408,10 @@ class IfcViewer(QMainWindow):
         if view == self.middle_view:
             # Get the selected entity
             step_id = index.sibling(index.row(), 0).data()  # column 0 = "STEP ID"
-            entity = self.ifc_model.by_id(int(step_id[1:])) # Get the entity selected by the user
+            entity = self.entity_model().by_id(int(step_id[1:])) # Get the entity selected by the user
         else:
             # Get the selected entity
-            entity = view.model().itemFromIndex(index).data()
+            entity = self.tree_entity(view, index)
 
         if not entity:
             return
@@ -303,7 +431,9 @@ class IfcViewer(QMainWindow):
             CONTEXT_MENU_ACTION_KEYS,
             context_menu_actions
         ): # Not every entity has a GUID so skip
-            if "step" in label.lower(): # If the step id is needed, pass it in as an argument
+            if handler is copy_step_line: # Copy the original step line from the file when it has been indexed
+                action = TAction(label, self, context=translator_context, triggered=handler, triggered_args=(entity, self.step_index), format_args={"id": entity.id()})
+            elif "step" in label.lower(): # If the step id is needed, pass it in as an argument
                 action = TAction(label, self, context=translator_context, triggered=handler, triggered_args=entity, format_args={"id": entity.id()})
             elif "GUID" in label: # If the GUID is needed, pass it in as an argument
                 try:
@@ -319,89 +449,264 @@ class IfcViewer(QMainWindow):
         menu.exec(view.viewport().mapToGlobal(position))
         
     def stats_label_clicked(self, ifc_type):
-        self.filter_bar.setText(ifc_type)
+        self.filter_bar.setText(f"type:{ifc_type}")
         self.apply_filter()
  
-    def load_ifc(self, file_path):
+    # browse: Read the entities straight from the step lines instead of loading the model into ifcopenshell
+    #         Files larger than the available memory can be browsed this way
+    def load_ifc(self, file_path, browse=False):
         self.setWindowTitle(os.path.basename(file_path))
         self.file_path = file_path
-        self.start_load_ifc_task(file_path)
+        self.start_load_ifc_task(file_path, browse)
    
-    def start_load_ifc_task(self, file_path):
-        if os.path.exists(file_path):
-            self.load_ifc_worker = SimpleIFCWorker(task_fn=lambda: ifcopenshell.open(file_path))
-        else:
+    def start_load_ifc_task(self, file_path, browse=False):
+        if not os.path.exists(file_path):
             # "{file_path} not found!"
             QMessageBox.critical(self, "Error", self.tr("{} not found!").format(self.file_path))
             return
+
+        # Stop loading the previous file and free its memory before reading the next one
+        self.stop_workers()
+        self.release_model()
+
+        self.load_ifc_worker = OpenIFCWorker(file_path, browse=browse)
             
         # f"Now loading: {os.path.basename(file_path)}"
         self.status_label.setText(MAIN_STATUS_LABEL_KEYS[1], format_args={"file_path": os.path.basename(file_path)})
         self.spinner_timer.start()
+        self.show_progress_bar()
+        self.load_start = time.perf_counter()
+        self.stage_times = {}
+        self.pending_loads = {"model", "entities"}
 
         self.load_ifc_worker.progress.connect(self.update_spinner)
+        self.load_ifc_worker.progress.connect(lambda percent: self.update_stage_progress(STAGE_OPEN, percent))
+        self.load_ifc_worker.indexed.connect(self.step_model_ready)
         self.load_ifc_worker.finished.connect(self.ifc_file_loaded)
         self.load_ifc_worker.start()
-    
-    def start_load_db_task(self):
+
+    # Start filling the entity table from the step lines while ifcopenshell keeps parsing
+    @Slot(object)
+    def step_model_ready(self, step_model):
+        self.step_model = step_model
+        self.step_index = step_model.step_index
+        self.load_entities()
+
+    # Entities are looked up in the StepModel until ifcopenshell has opened the file
+    def entity_model(self):
+        return self.ifc_model if self.ifc_model is not None else self.step_model
+
+    # Called whenever a part of the load finishes. The load is done once nothing is pending
+    def loading_finished(self, part):
+        self.pending_loads.discard(part)
+        if self.pending_loads:
+            return
+
+        self.spinner_timer.stop()
+        self.hide_progress_bar()
+        # f"Finished loading {os.path.basename(self.file_path)}"
+        self.status_label.setText(MAIN_STATUS_LABEL_KEYS[3], format_args={"file_path": os.path.basename(self.file_path)})
+
+        # Update stats on the righthand side
+        self.load_end = time.perf_counter()
+        self.update_stats_panel()
+
+    # Cancel every worker that is still loading something
+    # Their signals are blocked so nothing they finish afterwards reaches the views
+    def stop_workers(self, names=("load_ifc_worker", "load_db_worker", "export_model_worker")):
+        for name in names:
+            worker = getattr(self, name, None)
+            if worker and worker.isRunning():
+                worker.blockSignals(True)
+                worker.cancel()
+                self.cancelled_workers.append(worker)
+        self.cancelled_workers = [worker for worker in self.cancelled_workers if worker.isRunning()]
+
+    # Drop everything belonging to the current file
+    def release_model(self):
+        self.selection_timer.stop()
+        self.pending_selection = None
+        self.release_middle_model()
+        self.left_model.clear()
+        self.right_model.clear()
+        self.ifc_model = None
+        self.step_model = None
+        self.type_stats = {}
+        if self.step_index:
+            self.step_index.close()
+            self.step_index = None
+
+    def cancel_loading(self):
         if not self.spinner_timer.isActive():
+            return
+
+        export_model_worker = getattr(self, "export_model_worker", None)
+        if export_model_worker and export_model_worker.isRunning():
+            self.stop_workers(["export_model_worker"]) # Keep browsing the file without the exporter
+            if self.middle_model:
+                self.update_row_count()
+        else:
+            self.stop_workers()
+            self.release_model()
+            self.row_count_label.setText(ROW_COUNT_KEY, format_args={"items": 0})
+
+        self.spinner_timer.stop()
+        self.hide_progress_bar()
+        # f"Cancelled loading {os.path.basename(self.file_path)}"
+        self.status_label.setText(MAIN_STATUS_LABEL_KEYS[6], format_args={"file_path": os.path.basename(self.file_path)})
+
+    def show_progress_bar(self):
+        self.row_count_bar_stack.setCurrentWidget(self.progress_bar)
+        self.row_count_label.hide()
+        self.progress_bar.show()
+        self.progress_bar.setFormat("%p%")
+        self.progress_bar.setValue(0)
+
+    def hide_progress_bar(self):
+        self.progress_bar.hide()
+        self.row_count_label.show()
+        self.row_count_bar_stack.setCurrentWidget(self.row_count_label)
+
+    # Rebuild the entity table of the file that is already open
+    def start_load_db_task(self):
+        if self.entity_model() is not None and not self.spinner_timer.isActive():
             # "Now loading IFC model into view"
             self.status_label.setText(MAIN_STATUS_LABEL_KEYS[2])
             self.spinner_timer.start()
             self.load_start = time.perf_counter()
+            self.stage_times = {}
+            self.pending_loads = {"entities"}
+            self.load_entities()
 
-            self.middle_model = None
+    def load_entities(self):
+        self.release_middle_model()
 
-            self.load_db_worker = DBWorker(self.ifc_model)
-            self.load_db_worker.progress.connect(self.update_spinner)
-            self.load_db_worker.progress.connect(self.update_progress_bar)
-            self.load_db_worker.finished.connect(self.load_db_finished)
-            self.load_db_worker.start()
+        # If the entities of this file have already been indexed, skip DBWorker entirely
+        cached_db_uri = entity_cache.lookup(self.file_path)
+        if cached_db_uri:
+            self.load_db_finished(cached_db_uri, None)
+            return
 
-            # Display progress bar
-            self.row_count_bar_stack.setCurrentWidget(self.progress_bar)
-            self.row_count_label.hide()
-            self.progress_bar.show()
-            self.progress_bar.setValue(0)
+        config = load_config()
+        self.load_db_worker = DBWorker(self.step_model if self.step_model is not None else self.ifc_model,
+                                       file_path=self.file_path,
+                                       processes=config.get("db_worker_processes", 1),
+                                       index_properties=config.get("index_properties", INDEX_PROPERTIES))
+        self.load_db_worker.progress.connect(self.update_spinner)
+        self.load_db_worker.progress.connect(lambda percent: self.update_stage_progress(STAGE_ROWS, percent))
+        self.load_db_worker.stage_progress.connect(self.update_stage_progress)
+        self.load_db_worker.stage_finished.connect(self.stage_finished)
+        self.load_db_worker.rows_committed.connect(self.db_rows_committed)
+        self.load_db_worker.table_ready.connect(self.db_table_ready)
+        self.load_db_worker.finished.connect(self.load_db_finished)
+        self.load_db_worker.start()
+
+        self.show_progress_bar()
 
     def update_row_count(self):
         self.row_count = self.middle_model.rowCount()
+        if self.middle_model.loading and self.progress_bar.isHidden():
+            return # Rows are still being inserted with the progress bar hidden so leave the last count until they are all in
         self.row_count_label.setText(ROW_COUNT_KEY, format_args={"items": self.row_count})
 
-    @Slot(str)
-    def load_db_finished(self, db_uri):
-        self.spinner_timer.stop()
-        # f"Finished loading {os.path.basename(self.file_path)}"
-        self.status_label.setText(MAIN_STATUS_LABEL_KEYS[3], format_args={"file_path": os.path.basename(self.file_path)})
-
-        self.middle_model = SqlEntityTableModel(db_path=db_uri)
+    # Close the database of the previous file and delete it if it was built by DBWorker
+    def release_middle_model(self):
+        self.middle_view.setModel(None)
+        if self.middle_model:
+            self.middle_model.close()
+            self.middle_model = None
+        self.entity_summaries = None
+
+        load_db_worker = getattr(self, "load_db_worker", None)
+        if load_db_worker and load_db_worker.isFinished():
+            load_db_worker.remove_db_files()
+
+    # text_index: Whether the filter index has been built
+    def set_middle_model(self, db_uri, loading=False, text_index=True):
+        config = load_config()
+        self.middle_model = SqlEntityTableModel(db_path=db_uri, loading=loading, text_index=text_index,
+                                                page_size=config.get("table_page_size", PAGE_SIZE),
+                                                cache_pages=config.get("table_cache_pages", CACHE_PAGES),
+                                                result_cache_mb=config.get("result_cache_mb", RESULT_CACHE_MB),
+                                                log_cache_stats=config.get("log_cache_stats", LOG_CACHE_STATS))
         self.middle_view.setModel(self.middle_model)
+        self.entity_summaries = EntitySummaries(self.middle_model.db)
         self.middle_model.row_count_changed.connect(self.update_row_count)
+        self.middle_model.query_started.connect(self.filtering_started)
         self.update_row_count()
         self.middle_view.selectionModel().currentChanged.connect(self.handle_entity_selection)
 
-        # Hide progress bar
-        self.progress_bar.hide()
-        self.row_count_label.show()
-        self.row_count_bar_stack.setCurrentWidget(self.row_count_label)
+        if self.step_model: # Inverse references are looked up in the refs table
+            self.step_model.attach_db(self.middle_model.db)
+
+        # Filtering and sorting need the whole table
+        self.set_filter_enabled(not loading)
+
+    def set_filter_enabled(self, enabled):
+        self.filter_bar.setEnabled(enabled)
+        self.filter_button.setEnabled(enabled)
+        if enabled: # Enabling sorting sorts by the header's indicator so match the order the rows were loaded in
+            self.middle_view.horizontalHeader().setSortIndicator(STEP_ID_INDEX, Qt.AscendingOrder)
+        self.middle_view.setSortingEnabled(enabled)
+
+    # Show the rows DBWorker has committed so far
+    @Slot(int)
+    def db_rows_committed(self, inserted):
+        if self.middle_model is None:
+            self.set_middle_model(self.load_db_worker.db_uri, loading=True, text_index=False)
+        else:
+            self.middle_model.append_committed_rows()
+
+    # Every row is in and sortable while the filter index is still being built
+    @Slot(str)
+    def db_table_ready(self, db_uri):
+        if self.middle_model and self.middle_model.loading:
+            self.middle_model.finish_loading()
+            self.set_filter_enabled(True)
+            self.update_row_count()
+        elif self.middle_model is None:
+            self.set_middle_model(db_uri, text_index=False)
+        self.left_model.resume()
+
+    # histogram: {Ifc Type: (count, step line bytes)} from DBWorker, None for a cached database
+    @Slot(str, dict)
+    def load_db_finished(self, db_uri, histogram):
+        if self.middle_model and self.middle_model.loading: # The table was never reported ready
+            self.db_table_ready(db_uri)
+        if self.middle_model:
+            if not self.middle_model.text_index:
+                self.middle_model.finish_text_index()
+        else:
+            self.set_middle_model(db_uri)
+            self.left_model.resume()
+
+        self.type_stats = histogram if histogram is not None else type_stats(self.middle_model.db)
+
+        self.loading_finished("entities")
 
-        # Update stats on the righthand side
-        self.load_end = time.perf_counter()
-        self.update_stats_panel()
-    
     def update_stats_panel(self):
-        entity_dict = self.count_entities()
-        self.stats_panel.update_stats(self.ifc_model.schema,
-                                      entity_dict,
-                                      self.load_end - self.load_start)
-       
-    def count_entities(self):
-        entity_dict = defaultdict(int)
-        for entity in self.ifc_model:
-            entity_type = entity.is_a()
-            entity_dict[entity_type] += 1
+        model = self.entity_model()
+        self.stats_panel.update_stats(model.schema if model is not None else None,
+                                      self.type_stats,
+                                      self.load_end - self.load_start,
+                                      self.stage_times)
+
+    # Show the progress of a stage in the progress bar
+    # Opening the file and reading the entities run side by side so the entities take over the bar once they start
+    @Slot(int, int)
+    def update_stage_progress(self, stage, percent):
+        load_db_worker = getattr(self, "load_db_worker", None)
+        if stage == STAGE_OPEN and load_db_worker and load_db_worker.isRunning():
+            return
+        stage_name = QCoreApplication.translate("Load Stages", LOAD_STAGE_KEYS[stage])
+        self.progress_bar.setFormat(f"{stage_name} %p%")
+        self.progress_bar.setValue(percent)
 
-        return dict(entity_dict)
+    @Slot(int, float)
+    def stage_finished(self, stage, seconds):
+        stage_name = QCoreApplication.translate("Load Stages", LOAD_STAGE_KEYS[stage])
+        print(f"{stage_name} finished in {seconds:.2f}s")
+        self.stage_times[stage_name] = seconds
    
     @Slot()
     def update_spinner(self):
@@ -417,25 +722,18 @@ class IfcViewer(QMainWindow):
                                             # Only update the spinner
         self.current_frame += 1
     
-    def update_progress_bar(self, percent):
-        self.progress_bar.setValue(percent)
-        if percent >= 99:
-            self.progress_bar.hide()
-            self.row_count_label.show()
-            self.row_count_bar_stack.setCurrentWidget(self.row_count_label)
-            self.row_count_label.setText(BUILDING_INDEX_KEY)
-    
     @Slot(object)
     def ifc_file_loaded(self, result):
-        self.spinner_timer.stop()
         if isinstance(result, str) and result.startswith("Error"):
+            self.stop_workers()
+            self.release_model()
+            self.spinner_timer.stop()
+            self.hide_progress_bar()
             self.status_label.setText(result)
         else:
             try:
-                self.ifc_model = result
-                self.middle_view.setModel(None)
-                self.left_model.removeRows(0, self.left_model.rowCount())
-                self.right_model.removeRows(0, self.right_model.rowCount())
+                self.ifc_model, _ = result
+                self.stage_times[QCoreApplication.translate("Load Stages", LOAD_STAGE_KEYS[STAGE_OPEN])] = time.perf_counter() - self.load_start
 
                 if self.file_path in self.recent_files:
                     self.recent_files.remove(self.file_path)
@@ -443,8 +741,10 @@ class IfcViewer(QMainWindow):
                 self.recent_files = self.recent_files[:self.max_recent_files]
                 self.update_recent_files_menu()
                 self.save_recent_files()
-                # f"Loaded {os.path.basename(self.file_path)}"\nPress the \"Load Entities\" button to view the contents"
-                self.status_label.setText(MAIN_STATUS_LABEL_KEYS[4], format_args={"file_path": os.path.basename(self.file_path)})
+
+                if self.step_model is None: # The step lines could not be indexed so build the entity table from the model
+                    self.load_entities()
+                self.loading_finished("model")
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Failed to open IFC file:\n{str(e)}")
         
@@ -502,159 +802,212 @@ class IfcViewer(QMainWindow):
             print("Error saving config:", e)
 
     def open_ifc_file(self):
-        if self.spinner_timer.isActive(): # Do not allow the user to use the toolbar while loading
-                                          # to prevent unexpected behavior
-            return
+        # Opening another file while loading cancels the current load
         path, _ = QFileDialog.getOpenFileName(self, "Open IFC File", "", "IFC Files (*.ifc)")
         if path:
             self.load_ifc(path)
 
+    def browse_ifc_file(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Browse IFC File", "", "IFC Files (*.ifc)")
+        if path:
+            self.load_ifc(path, browse=True)
+
+    # Only remember the selection here. show_selection shows the latest one once the current row stays put,
+    # and whatever was still being read for an earlier one is cancelled by the tree models
     def handle_entity_selection(self, index):
         sender = self.sender()
 
         if sender == self.middle_view.selectionModel():
-            # Assume using the step id displayed in the middle view to look up in the ifc model
-            # is faster than looking up in the SQL database
+            # Use the step id displayed in the middle view. Its page is already in memory
             step_id = index.sibling(index.row(), 0).data()  # column 0 = "STEP ID"
-
-            # Remove the preceding "#" when looking up by step id in the ifc model
-            entity = self.ifc_model.by_id(int(step_id[1:])) # Get the entity selected by the user
-
-            # Update the left and right views
-            self.populate_left_view(entity)
-            self.populate_right_view(entity)
+            if not step_id:
+                return
+            self.pending_selection = (int(step_id[1:]), True) # Remove the preceding "#"
         elif sender == self.left_view.selectionModel():
-            # Get the selected entity
-            entity = self.left_model.itemFromIndex(index).data()
-            # Update the right view
-            self.populate_right_view(entity)
-        
-        # f"Selected entity #{entity.id()}"
-        self.status_label.setText(MAIN_STATUS_LABEL_KEYS[5], format_args={"id": str(entity.id())})
-
-    def populate_right_view(self, entity):
-        #TODO: Improve performance for huge lists
-        self.right_model.removeRows(0, self.right_model.rowCount())
-
-        root_item = self.create_lazy_item(entity)
-        root_item.setFlags(root_item.flags() & ~Qt.ItemIsEditable) # Disallow editing
-        self.right_model.appendRow(root_item)
-
-    def lazy_load_forward_references(self, index):
-        item = self.right_model.itemFromIndex(index)
-        if not item:
-            return
-
-        if item.hasChildren() and item.child(0).text() == "Loading...":
-            item.removeRows(0, item.rowCount())  # Remove placeholder
-
-            entity = item.data()
-            if not entity:
+            step_id = self.left_model.step_id(index)
+            if step_id is None: # The row loading the next page
                 return
-
-            children = []
-            info = entity.get_info() # Get the labels and values of the entity's attributes
-
-            for attr_label, attr in info.items():
-                # display all attributes in the root item up to 200 characters
-                root_label = item.text()
-                if len(root_label) < 200 and str(attr_label) != "id" and str(attr_label) != "type":
-                    item.setText(root_label + f" | {str(attr_label)}: {str(attr)}")
-
-                if isinstance(attr, ifcopenshell.entity_instance):
-                    children.append(attr)
-                elif isinstance(attr, (list, tuple)):
-                    for sub in attr:
-                        if isinstance(sub, ifcopenshell.entity_instance) and sub.id():
-                            children.append(sub)
-
-            if children:
-                # Sort by STEP ID before adding
-                children = sorted(children, key=lambda e: e.id())
-                for child in children:
-                    child_item = self.create_lazy_item(child)
-                    child_item.setFlags(child_item.flags() & ~Qt.ItemIsEditable)
-                    item.appendRow(child_item)
-            else:
-                # No entity references — show named attributes
-                for key, value in info.items():
-                    if key == "id" or key == "type":
-                        continue
-                    label = f"{key}: {value}"
-                    item.setFlags(item.flags() & ~Qt.ItemIsEditable)
-                    item.appendRow(QStandardItem(label))
-
-    def expand_entity_tree(self, parent_item, entity, lazy=False):
-        if not isinstance(entity, ifcopenshell.entity_instance):
+            self.pending_selection = (step_id, False)
+        else:
             return
+        self.selection_timer.start()
 
-        for attr in entity:
-            if isinstance(attr, ifcopenshell.entity_instance):
-                child = QStandardItem(self.create_entity_label(attr))
-                child.setData(attr)
-                if lazy:
-                    child.appendRow(QStandardItem("Loading..."))
-                else:
-                    self.expand_entity_tree(child, attr, lazy)
-                child.setFlags(child.flags() & ~Qt.ItemIsEditable)
-                parent_item.appendRow(child)
-            else:
-                child = QStandardItem(str(attr))
-                child.setFlags(child.flags() & ~Qt.ItemIsEditable)
-                parent_item.appendRow(child)
-
-    def load_entity_children(self, parent_item, entity):
-        self.expand_entity_tree(parent_item, entity, lazy=True)
-
-    def populate_left_view(self, entity):
-        self.left_model.removeRows(0, self.left_model.rowCount())
-        
-        root_item = self.create_lazy_item(entity)
-        root_item.setFlags(root_item.flags() & ~Qt.ItemIsEditable) # items in the view are editable by default so prevent editing
-        self.left_model.appendRow(root_item)
-
-    def create_lazy_item(self, ent):
-        item = QStandardItem(f"#{ent.id()} - {ent.is_a()} | Name: {ent.get_info().get('Name', 'N/A')}")
-        item.setData(ent)
-        item.setFlags(item.flags() & ~Qt.ItemIsEditable) # Set as non-editable
-
-        # Add placeholder child so it's expandable
-        item.appendRow(QStandardItem("Loading..."))
-        return item
-    
-    def lazy_load_inverse_references(self, index):
-        # Get the item the user is expanding
-        item = self.left_model.itemFromIndex(index)
-
-        if not item:
+    def show_selection(self):
+        self.selection_timer.stop()
+        if self.pending_selection is None:
             return
+        step_id, from_middle_view = self.pending_selection
+        self.pending_selection = None
+
+        # Update the left and right views, or only the right one for an entity of the left view
+        if from_middle_view:
+            self.populate_left_view(step_id)
+        self.populate_right_view(step_id)
+
+        # f"Selected entity #{step_id}"
+        self.status_label.setText(MAIN_STATUS_LABEL_KEYS[5], format_args={"id": str(step_id)})
+
+    def populate_right_view(self, step_id):
+        self.right_model.set_root(step_id)
+
+    def populate_left_view(self, step_id):
+        self.left_model.set_root(step_id)
+
+    # The entity of a row in the left or right view
+    def tree_entity(self, view, index):
+        step_id = view.model().step_id(index)
+        return self.entity_model().by_id(step_id) if step_id is not None else None
+
+    # The refs table is read once every row is in. Until then the forward references are parsed here
+    # and an entity expanded in the left view waits for the table
+    def references_ready(self):
+        return self.middle_model is not None and not self.middle_model.loading
+
+    # Entities referencing step_id for the left view
+    def inverse_reference_ids(self, step_id, after, limit):
+        return inverse_references(self.middle_model.db, step_id, after, limit)
+
+    # Hub entities like IfcOwnerHistory are referenced by most of a model so their references are read in the background
+    # along with their labels. Selecting another entity cancels it
+    def inverse_reference_worker(self, step_id, after, limit, count):
+        worker = ReferenceWorker(self.middle_model.db_path, step_id, after, limit, count,
+                                 preview_length=self.entity_summaries.preview_length)
+        worker.summaries_ready.connect(self.add_summaries)
+        return worker
+
+    def inverse_reference_count(self, step_id):
+        return reference_count(self.middle_model.db, step_id)
+
+    # Entities referenced by step_id for the right view
+    def forward_reference_ids(self, step_id, after, limit):
+        if self.references_ready():
+            return forward_references(self.middle_model.db, step_id, after, limit)
+        step_ids = sorted(self.attribute_references(self.entity_model().by_id(step_id)))
+        return step_ids[bisect.bisect_right(step_ids, after):][:limit]
+
+    def forward_reference_count(self, step_id):
+        if self.references_ready():
+            return forward_count(self.middle_model.db, step_id)
+        return len(self.attribute_references(self.entity_model().by_id(step_id)))
+
+    # The STEP IDs of the entities in the attributes of an entity and in the lists among them
+    def attribute_references(self, entity):
+        step_ids = set()
+        for attr in entity:
+            if isinstance(attr, ENTITY_TYPES):
+                step_ids.add(attr.id())
+            elif isinstance(attr, (list, tuple)):
+                step_ids.update(sub.id() for sub in attr if isinstance(sub, ENTITY_TYPES) and sub.id())
+        return step_ids
+
+    # Rows shown under an entity of the right view that references nothing, read from its original step line.
+    # Lists like the coordinates of an IfcCartesianPointList3D become rows that show their elements a page at a time
+    def attribute_rows(self, step_id):
+        entity = self.entity_model().by_id(step_id)
+        raw = self.step_index.raw(step_id) if self.step_index else None
+        if raw is None:
+            raw = instance_line(entity).encode() # Quotes in strings escaped like the original step line
+        if isinstance(entity, RawEntity):
+            names = entity.attribute_names()
+        else:
+            names = [entity.attribute_name(i) for i in range(len(entity))]
+
+        rows = []
+        for i, (start, end) in enumerate(attribute_spans(raw)):
+            name = names[i] if i < len(names) else f"Attribute {i}"
+            if raw[start:start + 1] == b"(":
+                attribute = AggregateAttribute(name, raw, (start, end))
+                if len(attribute) > INLINE_LIST_LENGTH:
+                    rows.append(attribute)
+                    continue
+            value = parse_value(raw[start:end])
+            if self.step_model: # IFCLABEL('B-12') is shown as IfcLabel('B-12')
+                value = self.step_model.wrap(value)
+            rows.append(f"{name}: {value}")
+        return rows
 
-        # Display the selected entity's attributes on its line
-        item.setText(self.create_entity_label(item.data()))
-
-        # Check if already loaded
-        if item.hasChildren() and item.child(0).text() == "Loading...":
-            item.removeRows(0, item.rowCount())  # Remove placeholder
-
-            entity = item.data()
-            if not entity:
-                return
-
-            # Get and sort referencing entities by ID
-            references = sorted(self.ifc_model.get_inverse(entity), key=lambda ref: ref.id())
-
-            for ref in references:
-                child_item = self.create_lazy_item(ref)
-                child_item.setText(self.create_entity_label(child_item.data()))
-                item.appendRow(child_item)
+    # Keep the labels a ReferenceWorker read, unless they come from the database of an earlier file
+    @Slot(object)
+    def add_summaries(self, rows):
+        if self.entity_summaries and self.sender().db_path == self.middle_model.db_path:
+            self.entity_summaries.add(rows)
+
+    # Read the labels of a page of tree rows at once
+    def prefetch_summaries(self, step_ids):
+        if self.entity_summaries:
+            self.entity_summaries.fetch(step_ids)
+
+    # (Ifc Type, GUID, Name, start of the step line) from the database, None until the row of step_id is in
+    def entity_summary(self, step_id):
+        return self.entity_summaries.get(step_id) if self.entity_summaries else None
+
+    # An expanded entity of the left view shows its GUID and Name
+    def inverse_tree_label(self, step_id, expanded):
+        summary = self.entity_summary(step_id)
+        if summary is None:
+            return self.create_entity_label(self.entity_model().by_id(step_id))
+        ifc_type, guid, name, _ = summary # Rows store "" for an attribute the type does not have
+        return f"#{step_id} {ifc_type}".ljust(30) + f"GUID: {guid or None} | Name: {None if name == '' else name}"
+
+    # An expanded entity of the right view shows the start of its original step line
+    # rather than serializing every attribute again
+    def forward_tree_label(self, step_id, expanded):
+        summary = self.entity_summary(step_id)
+        if summary is not None:
+            ifc_type, _, name, step_line = summary
+            label = f"#{step_id} - {ifc_type} | Name: {'N/A' if name == '' else name}"
+            if not expanded:
+                return label
+            return (self.step_index.line_prefix(step_id, 200) if self.step_index else None) or step_line
+
+        entity = self.entity_model().by_id(step_id)
+        info = entity.get_info()
+        label = f"#{step_id} - {entity.is_a()} | Name: {info.get('Name', 'N/A')}"
+        if not expanded:
+            return label
+
+        step_line = self.step_index.line_prefix(step_id, 200) if self.step_index else None
+        if step_line:
+            return step_line
+        for attr_label, attr in info.items(): # Display the attributes on its line up to 200 characters
+            if len(label) < 200 and attr_label not in ("id", "type"):
+                label += f" | {attr_label}: {attr}"
+        return label
 
 # ==============================
 # Exporter
 # ==============================
 
     def show_exporter(self, export_type):
+        if self.ifc_model is None: # Still opening the file
+            return
+        if isinstance(self.ifc_model, StepModel): # The exporters need the whole model so load it only now
+            if self.spinner_timer.isActive():
+                return
+            # f"Now loading: {os.path.basename(file_path)}"
+            self.status_label.setText(MAIN_STATUS_LABEL_KEYS[1], format_args={"file_path": os.path.basename(self.file_path)})
+            self.spinner_timer.start()
+            self.show_progress_bar()
+            self.export_model_worker = OpenIFCWorker(self.file_path, index=False)
+            self.export_model_worker.progress.connect(self.progress_bar.setValue)
+            self.export_model_worker.finished.connect(lambda result: self.export_model_loaded(result, export_type))
+            self.export_model_worker.start()
+            return
+        self.open_exporter(self.ifc_model, export_type)
+
+    def export_model_loaded(self, result, export_type):
+        self.spinner_timer.stop()
+        self.hide_progress_bar()
+        if isinstance(result, str):
+            self.status_label.setText(result)
+            return
+        # f"Finished loading {os.path.basename(self.file_path)}"
+        self.status_label.setText(MAIN_STATUS_LABEL_KEYS[3], format_args={"file_path": os.path.basename(self.file_path)})
+        self.open_exporter(result[0], export_type)
+
+    def open_exporter(self, ifc_model, export_type):
         self.export_view = ExporterWindow(title=os.path.basename(self.file_path),
-                                          ifc_model=self.ifc_model,
+                                          ifc_model=ifc_model,
                                           parent=self,
                                           export_type=export_type)
         self.export_view.show()
@@ -690,6 +1043,7 @@ class IfcViewer(QMainWindow):
             print(f"Unable to install {language_code} translator")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # DBWorker can extract rows in child processes
     file_path = sys.argv[1] if len(sys.argv) > 1 else None
     app = QApplication(sys.argv)
     font_id = QFontDatabase.addApplicationFont("fonts/Inter-VariableFont_opsz,wght.ttf")
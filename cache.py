@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import pathlib
+import apsw
+
+from options import load_config
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache") # On-disk copies of the entity databases
+                                                             # index.json inside keeps track of which IFC file each copy belongs to
+
+CACHE_SCHEMA_VERSION = 8 # Bump this whenever the layout of the entity database changes
+                         # so databases written by older versions are thrown away instead of read
+
+DEFAULT_CACHE_LIMIT_GB = 8
+HASH_SAMPLE_SIZE = 1024 * 1024 # Hashing a 4 GB file takes longer than rebuilding a small model
+                               # so only the start, middle and end of the file are hashed
+
+# The EntityCache class keeps an on-disk copy of the database built by DBWorker for every
+# IFC file the user has loaded. Reopening an unchanged file hands the cached database straight
+# to SqlEntityTableModel instead of rebuilding entities and fts_entities from scratch.
+# Entries are keyed by file path, size, modification time and a content hash and the total size
+# of the cache is kept under the limit set in the options dialog by evicting the least recently used models.
+class EntityCache:
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self._lock = threading.Lock() # DBWorker stores entries from a background thread
+
+    # Identify the current state of an IFC file
+    def file_key(self, file_path):
+        stat = os.stat(file_path)
+        return {
+            "path": os.path.abspath(file_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": self.content_hash(file_path, stat.st_size),
+            "version": CACHE_SCHEMA_VERSION
+        }
+
+    def content_hash(self, file_path, size):
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(file_path, "rb") as f:
+            for offset in (0, max(0, size // 2 - HASH_SAMPLE_SIZE // 2), max(0, size - HASH_SAMPLE_SIZE)):
+                f.seek(offset)
+                digest.update(f.read(HASH_SAMPLE_SIZE))
+        return digest.hexdigest()
+
+    # Return a read-only uri for the cached database of file_path or None if there is no valid entry
+    def lookup(self, file_path):
+        try:
+            key = self.file_key(file_path)
+        except OSError:
+            return None
+
+        with self._lock:
+            index = self._load_index()
+            entry = index.get(key["path"])
+            if not entry:
+                return None
+
+            db_path = os.path.join(self.cache_dir, entry["db"])
+            if any(entry.get(k) != key[k] for k in ("size", "mtime", "hash", "version")) or not os.path.exists(db_path):
+                # The file changed since it was cached so the entry is no longer valid
+                print(f"Invalidating cached entities for {key['path']}")
+                self._remove_entry(index, key["path"])
+                self._save_index(index)
+                return None
+
+            entry["last_used"] = time.time()
+            self._save_index(index)
+
+        print(f"Using cached entities for {key['path']}")
+        return pathlib.Path(db_path).resolve().as_uri() + "?mode=ro"
+
+    # Copy the database behind conn into the cache under the key computed before it was built
+    def store(self, key, conn):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        db_name = f"{uuid.uuid4().hex}.db"
+        db_path = os.path.join(self.cache_dir, db_name)
+
+        try:
+            disk_conn = apsw.Connection(db_path)
+            with disk_conn.backup("main", conn, "main") as backup:
+                while not backup.done:
+                    backup.step(1000)
+            disk_conn.execute("PRAGMA journal_mode = DELETE") # The copy is opened read-only so it cannot use WAL
+            disk_conn.close()
+        except Exception as e:
+            print(f"Failed to cache entities\n{e}")
+            self._delete_file(db_path)
+            return
+
+        size = os.path.getsize(db_path)
+        if size > self.limit_bytes(): # Never evict everything else to make room for a single model that does not fit
+            self._delete_file(db_path)
+            return
+
+        with self._lock:
+            index = self._load_index()
+            self._remove_entry(index, key["path"])
+            index[key["path"]] = dict(key, db=db_name, bytes=size, last_used=time.time())
+            self._evict(index)
+            self._save_index(index)
+
+    # Remove every cached database
+    def clear(self):
+        with self._lock:
+            index = self._load_index()
+            for path in list(index):
+                self._remove_entry(index, path)
+            self._save_index(index)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry.get("bytes", 0) for entry in self._load_index().values())
+
+    def limit_bytes(self):
+        return int(load_config().get("cache_limit_gb", DEFAULT_CACHE_LIMIT_GB) * 1024 ** 3)
+
+    # Remove the least recently used entries until the cache fits within the limit
+    def _evict(self, index):
+        limit = self.limit_bytes()
+        total = sum(entry.get("bytes", 0) for entry in index.values())
+        for path, entry in sorted(index.items(), key=lambda item: item[1].get("last_used", 0)):
+            if total <= limit:
+                break
+            total -= entry.get("bytes", 0)
+            print(f"Evicting cached entities for {path}")
+            self._remove_entry(index, path)
+
+    def _remove_entry(self, index, path):
+        entry = index.pop(path, None)
+        if entry:
+            self._delete_file(os.path.join(self.cache_dir, entry["db"]))
+
+    def _delete_file(self, db_path):
+        try:
+            if os.path.exists(db_path):
+                os.remove(db_path)
+        except OSError as e: # The database may still be open in the middle view
+            print(f"Unable to delete {db_path}\n{e}")
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r") as f:
+                    return json.load(f)
+            except Exception:
+                return {}
+        return {}
+
+    def _save_index(self, index):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.index_path, "w") as f:
+                json.dump(index, f, indent=4)
+        except Exception as e:
+            print("Error saving cache index:", e)
+
+entity_cache = EntityCache() # The global entity cache
+                             # Shared by DBWorker, the main window and the options dialog
@@ -1,15 +1,33 @@
 import apsw
+import os
+import sys
 import uuid
-import functools
+import atexit
+import pathlib
+import tempfile
+from collections import OrderedDict
+import itertools
+from array import array
+import multiprocessing
 import re
-from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex, QThread, Signal
+import time
+import ifcopenshell
+import ifcopenshell.ifcopenshell_wrapper
+from cache import entity_cache
+from step_index import StepIndex
+from step_model import StepModel, TypedValue, INSTANCE_HEAD, parse_instance, references
+from query import FilterQuery, compile_filter
+from short_index import ShortTermIndex
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex, QThread, QTimer, Signal, Slot
 
-DB_URI = "file:memdb1?mode=memory&cache=shared" # In memory database to be shared between threads
-                                                # SQLite is not thread safe and in memory databases are
-                                                # garbage collected upon closing the connection so this type of
-                                                # shared in-memory database allows a background thread to load
-                                                # the elements without blocking the main thread as long as the insert
-                                                # is finished before attempting to read.
+DB_DIR = os.path.join(tempfile.gettempdir(), "ifcbrowser") # Databases shared between threads
+                                                           # SQLite is not thread safe so DBWorker and the main thread
+                                                           # each use their own connection to the same database file.
+                                                           # The apsw wheels are built without shared cache support so a shared
+                                                           # in-memory database cannot be used and memdb databases lock readers
+                                                           # out for the whole length of every write. A temporary file in WAL mode
+                                                           # lets the main thread read the rows DBWorker has committed while it keeps
+                                                           # inserting and the OS page cache keeps it close to in-memory speed.
 
 COLUMNS = ["STEP ID", "Ifc Type", "GUID", "Name", "STEP Line"]
 COLUMNS_SQL = ", ".join(f'"{col}"' for col in COLUMNS) # Define the columns here and use this variable throughout the program
@@ -20,170 +38,1062 @@ GUID_INDEX = 2
 NAME_INDEX = 3
 STEP_LINE_INDEX = 4
 
+# The rows are stored in entities with the type of each one as an id from the types table.
+# base_entities joins them back into the columns of the middle view and is what the middle view queries
+ENTITY_COLUMNS_SQL = 'id, type_id, "GUID", "Name", "STEP Line", name_key'
+BASE_ENTITIES_SQL = """
+    CREATE VIEW base_entities AS
+    SELECT e.id AS id, e.id AS "STEP ID", t.name AS "Ifc Type", e."GUID" AS "GUID", e."Name" AS "Name",
+           e."STEP Line" AS "STEP Line", e.name_key AS name_key, e.type_id AS type_id
+    FROM entities e JOIN types t ON t.id = e.type_id
+"""
+# A row for every single value property of every entity. The names and text ignore case like the rest of the filter bar
+PROPERTY_COLUMNS_SQL = "entity_id INTEGER, pset TEXT COLLATE NOCASE, property TEXT COLLATE NOCASE, value_text TEXT COLLATE NOCASE, value_num REAL"
+TEXT_COLUMNS_SQL = '"GUID", "Name", "STEP Line"' # Columns of the filter index. Types are matched through the types table
+
+# What each column is sorted by. Name is sorted by name_key, a hidden column holding its natural sort key
+# and Ifc Type by type_id since type ids follow the alphabetical order of the types (see type_ids)
+# Every one of them has an index built by DBWorker so sorting is an index scan
+SORT_KEYS = {
+    "STEP ID": "id",
+    "Ifc Type": "type_id",
+    "GUID": '"GUID"',
+    "Name": "name_key",
+    "STEP Line": '"STEP Line"'
+}
+DIGITS = re.compile(r"\d+")
+
+FIRST_CHUNK_SIZE = 1000 # Number of rows committed before the middle view is first shown
+
+# Stages DBWorker goes through. Stage 0 is opening the file which happens outside of DBWorker
+STAGE_ROWS = 1         # Inserting the rows of the middle view and the references between entities
+STAGE_REFERENCES = 2   # Indexing the references for inverse and forward lookups
+STAGE_TYPES = 3        # Storing the number of entities and step line bytes of each type
+STAGE_SORT_INDEXES = 4 # Indexing every sortable column
+STAGE_FILTER_INDEX = 5 # Building the full text index used for filtering
+STAGE_PROPERTIES = 6   # Flattening the property sets into the properties table. Skipped unless index_properties
+BUSY_TIMEOUT_MS = 100   # How long the middle view waits for DBWorker to release the database
+
+PAGE_SIZE = 512    # Rows fetched by the middle view in a single query. "table_page_size" in config.json
+CACHE_PAGES = 64   # Pages kept in memory by the middle view. "table_cache_pages" in config.json
+LOG_CACHE_STATS = False # Print the page cache counters whenever the middle view fetches a page. "log_cache_stats" in config.json
+ROW_ID_CHUNK = 65536 # Row ids read from a cursor at a time
+REFERENCE_PAGE_SIZE = 1000 # References read at a time for the reference trees
+REFERENCE_CHUNK_SIZE = 100 # References a ReferenceWorker hands to the left view at a time
+SUMMARY_CACHE_SIZE = 20000 # Entities whose tree labels are kept by EntitySummaries
+SUMMARY_PREVIEW_LENGTH = 200 # Characters of the step line kept for the label of an expanded entity
+RESULT_CACHE_MB = 64 # Memory for the rows of recent filters and sorts. "result_cache_mb" in config.json
+FTS_CHUNK_SIZE = 20000 # Rows added to the filter index in a single transaction
+INDEX_PROPERTIES = True # Whether the properties table is built. "index_properties" in config.json
+REFINE_ROW_LIMIT = 20000 # Largest earlier result a filter is checked against instead of searching every row
+                         # Above it, checking the rows one by one takes longer than the indexes take to search
+
+# apsw only understands uri filenames when asked to
+# Without SQLITE_OPEN_URI, "file:<name>?..." becomes a file on disk with that name
+def connect(db_uri):
+    return apsw.Connection(db_uri, flags=apsw.SQLITE_OPEN_READWRITE | apsw.SQLITE_OPEN_CREATE | apsw.SQLITE_OPEN_URI)
+
 # The DBWorker class populates the database used to display entities in the middle view.
-# SQLite is not thread safe but using the shared in memory database as defined in DB_URI,
+# SQLite is not thread safe but using a database file in DB_DIR,
 # DBWorker creates a connection solely used for inserting all the entities.
-# Once the insert is done, the main thread is notified so it can start reading.
-# TODO: Show the database populating in realtime (WAL mode?)
+# The inserts are committed in chunks and the main thread is notified after each one
+# so the middle view can start showing rows while the rest of the model is inserted.
+# Once every row is in and the sort indexes are built, table_ready lets the main thread enable sorting and
+# filtering on the indexed columns. The filter index is built last, a chunk of rows at a time, and finished is emitted once it is ready.
+# The references between entities are stored in the refs table with the index of the attribute holding them,
+# so inverse and forward references can be read a page at a time without going through the model.
+# When ifc_model is a StepModel, the rows are read straight from the original step lines and ifcopenshell is never used,
+# so the table can be filled while ifcopenshell is still opening the same file.
+# After the rows, the remaining stages run one after another and report their progress and how long they took.
+# The last one flattens the single value properties of every property set into the properties table for pset: and prop: filters.
+# The entities and step line bytes of each type are added up while the rows are inserted, stored in the types table
+# and sent with finished for the stats panel.
 class DBWorker(QThread):
-    progress = Signal(int)
-    finished = Signal(str)
+    progress = Signal(int)                # Progress of STAGE_ROWS
+    stage_progress = Signal(int, int)     # (stage, percent) for the stages after STAGE_ROWS
+    stage_finished = Signal(int, float)   # (stage, seconds)
+    rows_committed = Signal(int)          # Total number of rows committed so far
+    table_ready = Signal(str)             # Every row is in and sortable
+    finished = Signal(str, dict)          # The filter index is ready. {Ifc Type: (count, step line bytes)}
 
-    def __init__(self, ifc_model):
+    def __init__(self, ifc_model, file_path=None, processes=1, index_properties=INDEX_PROPERTIES):
         super().__init__()
         self.ifc_model = ifc_model
+        self.file_path = file_path # Used as the key when saving the finished database to the entity cache
+        self.processes = processes # Number of processes extracting rows. 1 extracts them in this thread
+        self.index_properties = index_properties
         self.db_uri = self.create_db_uri()
+        self.conn = None
+        _db_paths.add(self.db_path) # Do not leave the database behind when the program closes
+
+    # Stop inserting and building the filter index. Called from the main thread
+    def cancel(self):
+        self.requestInterruption()
+        try:
+            if self.conn:
+                self.conn.interrupt() # Abort the statement currently running in this thread
+        except apsw.ConnectionClosedError:
+            pass
     
     def create_db_uri(self):
         random_name = uuid.uuid4().hex
-        return f"file:{random_name}?mode=memory&cache=shared"
+        os.makedirs(DB_DIR, exist_ok=True)
+        self.db_path = os.path.join(DB_DIR, f"{random_name}.db")
+        return pathlib.Path(self.db_path).as_uri()
 
+    # Delete the database once nothing is reading from it anymore
+    def remove_db_files(self):
+        remove_db_files(self.db_path)
 
+    # The model is only needed for the rows so it is dropped as soon as the load ends, however it ends.
+    # So is the connection, after the database has been copied to the entity cache, along with its 1 GB page cache
+    # and the handles on the files remove_db_files deletes
     def run(self):
-        conn = apsw.Connection(self.db_uri)
+        try:
+            self.populate()
+        finally:
+            conn, self.conn = self.conn, None
+            if conn:
+                conn.close()
+            self.ifc_model = None
+
+    def populate(self):
+        # Identify the file before reading the model so changes made during the load invalidate the cache entry
+        cache_key = None
+        if self.file_path:
+            try:
+                cache_key = entity_cache.file_key(self.file_path)
+            except OSError as e:
+                print(f"Unable to cache {self.file_path}\n{e}")
+
+        conn = self.conn = connect(self.db_uri) # Create a connection solely for inserting the elements in this background thread
         cursor = conn.cursor()
         # DB optimizations for faster inserts
         # Perform these before apsw creates a transaction
-        cursor.execute("PRAGMA journal_mode = OFF")
+        # The exclusive locking mode is left out since it would lock the main thread out of the database
+        cursor.execute("PRAGMA journal_mode = WAL") # Readers are not blocked by the inserts
         cursor.execute("PRAGMA synchronous = OFF")
-        cursor.execute("PRAGMA locking_mode = EXCLUSIVE")
         cursor.execute("PRAGMA temp_store = MEMORY")
         cursor.execute("PRAGMA cache_size = -1000000")
         cursor.close()
 
-        with apsw.Connection(self.db_uri) as conn: # Create a connection solely for inserting the elements in this background thread
-            cursor = conn.cursor()
+        cursor = conn.cursor()
 
-            try:
-                cursor.execute("DROP TABLE IF EXISTS base_entities")
-                cursor.execute("DROP TABLE IF EXISTS fts_entities")
-            except Exception as e:
-                print(e)
+        try:
+            cursor.execute("DROP VIEW IF EXISTS base_entities")
+            cursor.execute("DROP TABLE IF EXISTS entities")
+            cursor.execute("DROP TABLE IF EXISTS types")
+            cursor.execute("DROP TABLE IF EXISTS fts_entities")
+            cursor.execute("DROP TABLE IF EXISTS refs")
+            cursor.execute("DROP TABLE IF EXISTS properties")
+        except Exception as e:
+            print(e)
+
+        # Create the base table, the type dictionary and the view joining them
+        try:
+            cursor.execute('CREATE TABLE entities (id INTEGER PRIMARY KEY, type_id INTEGER, "GUID", "Name", "STEP Line", name_key TEXT)')
+            cursor.execute("CREATE TABLE types (id INTEGER PRIMARY KEY, name TEXT UNIQUE, count INTEGER, bytes INTEGER)")
+            cursor.execute(BASE_ENTITIES_SQL)
+        except Exception as e:
+            print(f"failed to create base_entities\n{e}")
+
+        # Create the reference table. Each row is a reference from the entity src to the entity dst
+        # held by the attribute of src at attr_index
+        try:
+            cursor.execute("CREATE TABLE refs (src INTEGER, dst INTEGER, attr_index INTEGER)")
+        except Exception as e:
+            print(f"failed to create refs\n{e}")
+
+        # populate the base table
+        try:
+            browse = isinstance(self.ifc_model, StepModel)
+            parallel = self.processes > 1 and self.file_path
+            # A StepModel is read one step line at a time and the extraction processes open the file themselves,
+            # so the entities are only listed here when this thread extracts them from ifcopenshell
+            all_entities = None if browse or parallel else list(self.ifc_model)
+            if browse:
+                total_entities = len(self.ifc_model)
+            elif parallel:
+                total_entities = len(self.ifc_model.entity_names()) # Only the STEP IDs, without making an entity_instance for each
+            else:
+                total_entities = len(all_entities)
+            # Change batch size according to model size
+            batch_size = max(1, int(total_entities / 100))
+            print(f"batch size {batch_size} for db insert")
+
+            if parallel:
+                chunks = self.parallel_row_chunks(total_entities, batch_size)
+            elif browse:
+                chunks = self.step_row_chunks(batch_size)
+            else:
+                chunks = self.row_chunks(all_entities, batch_size)
 
-            # Create the base table
+            # Commit the inserts in chunks so the middle view can show the rows while the rest are inserted
+            stage_start = time.perf_counter()
+            inserted = 0
+            ranks = type_ids(self.ifc_model.schema)
+            known_types = {}
+            type_totals = {} # type_id: [count, step line bytes]
+            for rows, refs in chunks:
+                if self.isInterruptionRequested():
+                    chunks.close() # Stop the extraction processes
+                    raise apsw.InterruptError("Cancelled")
+                new_types = []
+                for row in rows:
+                    type_id = known_types.get(row[1])
+                    if type_id is None: # Types missing from the schema go after every other one
+                        type_id = known_types[row[1]] = ranks.get(row[1], len(ranks) + len(known_types))
+                        new_types.append((type_id, row[1]))
+                        type_totals[type_id] = [0, 0]
+                    row[1] = type_id
+                    totals = type_totals[type_id]
+                    totals[0] += 1
+                    totals[1] += row.pop() # Not inserted. The size of the full step line
+                with conn:
+                    cursor.executemany("INSERT INTO types (id, name) VALUES (?, ?)", new_types)
+                    cursor.executemany(f"INSERT INTO entities ({ENTITY_COLUMNS_SQL}) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                    cursor.executemany("INSERT INTO refs (src, dst, attr_index) VALUES (?, ?, ?)", refs)
+                inserted += len(rows)
+                self.rows_committed.emit(inserted)
+            stage_start = self.end_stage(STAGE_ROWS, stage_start)
+
+            self.stage_progress.emit(STAGE_REFERENCES, 0)
+            with conn:
+                # Both cover every lookup so the table itself is never read
+                cursor.execute("CREATE INDEX refs_dst ON refs (dst, src, attr_index)") # Inverse references
+                cursor.execute("CREATE INDEX refs_src ON refs (src, attr_index, dst)") # Forward references
+            stage_start = self.end_stage(STAGE_REFERENCES, stage_start)
+
+            self.stage_progress.emit(STAGE_TYPES, 0)
+            with conn:
+                cursor.executemany("UPDATE types SET count = ?, bytes = ? WHERE id = ?",
+                                   [(count, size, type_id) for type_id, (count, size) in type_totals.items()])
+            histogram = type_stats(conn)
+            stage_start = self.end_stage(STAGE_TYPES, stage_start)
+
+            self.stage_progress.emit(STAGE_SORT_INDEXES, 0)
+            with conn:
+                # Ties are broken by STEP ID so the order is the same every time and descending is the exact reverse
+                for i, sort_key in enumerate(SORT_KEYS.values()):
+                    if sort_key != "id":
+                        cursor.execute(f"CREATE INDEX sort_{i} ON entities ({sort_key}, id)")
+                # For name: filters which ignore case like the rest of the filter bar
+                cursor.execute('CREATE INDEX name_nocase ON entities ("Name" COLLATE NOCASE)')
+            stage_start = self.end_stage(STAGE_SORT_INDEXES, stage_start)
+            self.table_ready.emit(self.db_uri)
+
+            self.stage_progress.emit(STAGE_FILTER_INDEX, 0)
+            # Create the virtual table for filtering
             try:
-                cursor.execute(f"CREATE TABLE base_entities (id INTEGER PRIMARY KEY,{COLUMNS_SQL})")
+                cursor.execute(f"""CREATE VIRTUAL TABLE fts_entities USING fts5(
+                    {TEXT_COLUMNS_SQL},
+                    content='base_entities',
+                    content_rowid='id',
+                    tokenize='trigram remove_diacritics 1',
+                    )
+                """)
             except Exception as e:
-                print(f"failed to create base_entities\n{e}")
+                print(f"failed to create fts_entities\n{e}")
 
-            # populate the base table
-            try:
-                def row_generator(entities, progress_callback, batch_size=10000): # Use a generator rather than a list for lower memory usage
-                    total_entities = len(entities) # Total number of inserts for calculating progress
-                    for i, entity in enumerate(entities):
-                        info = entity.get_info()
-                        yield [
-                            entity.id(),                    # STEP ID
-                            entity.is_a(),                  # Ifc Type
-                            info.get("GlobalId", ""),       # GUID
-                            info.get("Name", ""),           # Name
-                            self.generate_step_line(str(entity)) # If the step line contains a long list of references, truncate the list and keep everything else
-                        ]
-                        if i % batch_size == 0 or i == total_entities: # Calculate current progress
-                            percent = int(i / total_entities * 100)
-                            progress_callback(percent)
-                            
-                all_entities = list(self.ifc_model)
-                # Change batch size according to model size
-                batch_size = int(len(all_entities) / 100)
-                print(f"batch size {batch_size} for db insert")
-                # Execute all inserts in one batch
-                cursor.executemany(f"INSERT INTO base_entities ({COLUMNS_SQL}) VALUES (?, ?, ?, ?, ?)", row_generator(all_entities, self.progress.emit, batch_size=batch_size))
-
-                # Create the virtual table for filtering
-                try:
-                    cursor.execute(f"""CREATE VIRTUAL TABLE fts_entities USING fts5(
-                        {COLUMNS_SQL},
-                        content='base_entities',
-                        content_rowid='id',
-                        tokenize='trigram remove_diacritics 1',
-                        )
-                    """)
-                except Exception as e:
-                    print(f"failed to create fts_entities\n{e}")
-
-                cursor.execute("INSERT INTO fts_entities(fts_entities) VALUES ('rebuild')")
-                
-                self.finished.emit(self.db_uri) # Send the uri to the main program now that it is finished inserting
-                cursor.close()
+            # Index the rows in chunks rather than with a single 'rebuild' to report progress and stop when cancelled
+            starts = read_ids(cursor.execute("SELECT id FROM entities ORDER BY id"))[::FTS_CHUNK_SIZE]
+            ends = starts[1:] + array("q", [2 ** 63 - 1])
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                if self.isInterruptionRequested():
+                    raise apsw.InterruptError("Cancelled")
+                with conn:
+                    cursor.execute(f"""INSERT INTO fts_entities (rowid, {TEXT_COLUMNS_SQL})
+                        SELECT id, {TEXT_COLUMNS_SQL} FROM entities WHERE id >= ? AND id < ?
+                    """, (start, end))
+                self.stage_progress.emit(STAGE_FILTER_INDEX, int((i + 1) / len(starts) * 100))
+            stage_start = self.end_stage(STAGE_FILTER_INDEX, stage_start)
 
-            except Exception as e:
-                print(f"Failed to populate DB\n{e}")
-                self.finished.emit(None)
-                cursor.close()
-
-    # If the step line contains a long list of references, truncate it to lighten the load on the middle view
-    def generate_step_line(self, step_line, max_refs=2):
-        if len(step_line) < 200:
-            return step_line
-
-        def replacer(match):
-            refs = [r.strip() for r in match.group(1).split(',')]
-            truncated = refs[:max_refs]
-            removed_count = len(refs) - max_refs
-            if removed_count > 0:
-                return f"({','.join(truncated)}...+{removed_count} more)"
-            else:
-                return f"({','.join(truncated)})"
+            if self.index_properties:
+                self.stage_progress.emit(STAGE_PROPERTIES, 0)
+                self.build_properties(cursor)
+                self.end_stage(STAGE_PROPERTIES, stage_start)
+            cursor.close()
+
+        except Exception as e:
+            cursor.close()
+            if self.isInterruptionRequested():
+                self.release()
+                return
+            print(f"Failed to populate DB\n{e}")
+            self.finished.emit(None, {})
+            return
+
+        self.finished.emit(self.db_uri, histogram) # Notify the main program that the filter index is ready
+
+        if cache_key:
+            entity_cache.store(cache_key, conn) # Skip all of this the next time the file is opened
+
+    # Flatten IfcRelDefinesByProperties -> IfcPropertySet -> IfcPropertySingleValue into a row for every entity and property
+    # The values are parsed once per property from the step lines in entities, which are never truncated for single values,
+    # and joined to the entities through the attributes recorded in refs. The table is created in the same transaction
+    # as its rows so the middle view only ever sees it complete
+    def build_properties(self, cursor):
+        types = dict(cursor.execute("SELECT name, id FROM types"))
+        cursor.execute("CREATE TEMP TABLE property_values (id INTEGER PRIMARY KEY, value_text, value_num)")
+        rows = cursor.execute('SELECT id, "STEP Line" FROM entities WHERE type_id = ?', (types.get("IfcPropertySingleValue"),))
+        while chunk := list(itertools.islice(rows, FTS_CHUNK_SIZE)):
+            if self.isInterruptionRequested():
+                raise apsw.InterruptError("Cancelled")
+            with self.conn:
+                self.conn.executemany("INSERT INTO property_values VALUES (?, ?, ?)",
+                                      [(step_id, *property_value(step_line)) for step_id, step_line in chunk])
+        self.stage_progress.emit(STAGE_PROPERTIES, 50)
+
+        with self.conn:
+            cursor.execute(f"CREATE TABLE properties ({PROPERTY_COLUMNS_SQL})")
+            # RelatedObjects and RelatingPropertyDefinition of IfcRelDefinesByProperties are its 5th and 6th attributes
+            # and HasProperties of IfcPropertySet its 5th
+            cursor.execute("""INSERT INTO properties (entity_id, pset, property, value_text, value_num)
+                SELECT objects.dst, pset."Name", property."Name", v.value_text, v.value_num
+                FROM entities pset
+                JOIN refs defines ON defines.dst = pset.id AND defines.attr_index = 5
+                JOIN entities rel ON rel.id = defines.src AND rel.type_id = ?
+                JOIN refs objects ON objects.src = rel.id AND objects.attr_index = 4
+                JOIN refs has ON has.src = pset.id AND has.attr_index = 4
+                JOIN property_values v ON v.id = has.dst
+                JOIN entities property ON property.id = v.id
+                WHERE pset.type_id = ?
+            """, (types.get("IfcRelDefinesByProperties"), types.get("IfcPropertySet")))
+            # Property names are nearly always given so they lead every index
+            cursor.execute("CREATE INDEX properties_text ON properties (property, value_text, pset, entity_id)")
+            cursor.execute("CREATE INDEX properties_num ON properties (property, value_num, pset, entity_id)")
+            cursor.execute("CREATE INDEX properties_pset ON properties (pset, entity_id)")
+        cursor.execute("DROP TABLE property_values")
+
+    # Report how long a stage took and return the start time of the next one
+    def end_stage(self, stage, stage_start):
+        now = time.perf_counter()
+        self.stage_progress.emit(stage, 100)
+        self.stage_finished.emit(stage, now - stage_start)
+        return now
+
+    # Free the model and the database of a cancelled load
+    def release(self):
+        conn, self.conn = self.conn, None
+        if conn:
+            conn.close()
+        self.ifc_model = None
+        self.remove_db_files()
+
+    # Extract the rows in this thread
+    def row_chunks(self, all_entities, batch_size):
+        def row_generator(entities, progress_callback, batch_size=10000): # Use a generator rather than a list for lower memory usage
+            total_entities = len(entities) # Total number of inserts for calculating progress
+            for i, entity in enumerate(entities):
+                yield entity_row(entity)
+                if i % batch_size == 0 or i == total_entities: # Calculate current progress
+                    percent = int(i / total_entities * 100)
+                    progress_callback(percent)
+
+        # ifcopenshell does not iterate in STEP ID order
+        # Insert in ascending order so the middle view can append each committed chunk to the end
+        all_entities.sort(key=lambda entity: entity.id())
+        rows = row_generator(all_entities, self.progress.emit, batch_size=batch_size)
+
+        return split_rows(rows, batch_size)
+
+    # Extract the rows from the original step lines of a StepModel
+    # The StepIndex is already sorted by STEP ID and only the attributes up to GlobalId and Name are parsed
+    def step_row_chunks(self, batch_size):
+        def row_generator(model, progress_callback):
+            total_entities = len(model)
+            for i, step_id in enumerate(model.step_index.ids):
+                yield step_row(model, step_id)
+                if i % batch_size == 0: # Calculate current progress
+                    progress_callback(int(i / total_entities * 100))
+
+        return split_rows(row_generator(self.ifc_model, self.progress.emit), batch_size)
+
+    # Extract the rows in a pool of processes
+    # For an ifcopenshell model, every process opens the file itself and sorts its entities by STEP ID the same way
+    # as row_chunks. Each of those processes holds a full copy of the model so memory usage grows with the number of processes.
+    # For a StepModel, every process only memory-maps the file and is handed the locations of the step lines to read.
+    # The STEP ID space is split into contiguous shards and the results are returned in shard order
+    # so the rows are identical to extracting them in this thread and still reach the single SQLite connection in ascending order.
+    def parallel_row_chunks(self, total_entities, batch_size):
+        chunk_size = max(batch_size, FIRST_CHUNK_SIZE)
+        bounds = [(0, min(FIRST_CHUNK_SIZE, total_entities))]
+        while bounds[-1][1] < total_entities:
+            start = bounds[-1][1]
+            bounds.append((start, min(start + chunk_size, total_entities)))
+
+        if isinstance(self.ifc_model, StepModel):
+            step_index = self.ifc_model.step_index
+            initializer, extract = init_step_extraction_worker, extract_step_rows
+            shards = ((step_index.ids[start:stop], step_index.offsets[start:stop], step_index.lengths[start:stop])
+                      for start, stop in bounds)
+        else:
+            initializer, extract = init_extraction_worker, extract_rows
+            shards = bounds
+
+        print(f"Extracting rows with {self.processes} processes")
+        context = multiprocessing.get_context("spawn") # Forking a process with a running Qt application is unsafe
+        with context.Pool(self.processes, initializer=initializer, initargs=(self.file_path,)) as pool:
+            inserted = 0
+            for rows, refs in pool.imap(extract, shards):
+                inserted += len(rows)
+                self.progress.emit(int(inserted / total_entities * 100))
+                yield rows, refs
+
+# Group (row, refs) pairs into chunks of (rows, refs) for a single commit each
+# Keep the first chunk small so the first rows show up as soon as possible
+def split_rows(rows, batch_size):
+    chunk_size = FIRST_CHUNK_SIZE
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        yield [row for row, _ in chunk], [ref for _, refs in chunk for ref in refs]
+        chunk_size = max(batch_size, FIRST_CHUNK_SIZE)
+
+# Build the row displayed in the middle view for an entity and the (src, dst, attr_index) of the references it makes
+# Only used when the step lines of the file could not be indexed. Otherwise step_row reads the original ones
+def entity_row(entity):
+    info = entity.get_info()
+    step_line = instance_line(entity)
+    encoded = step_line.encode()
+    return [
+        entity.id(),                    # STEP ID
+        entity.is_a(),                  # Ifc Type
+        info.get("GlobalId", ""),       # GUID
+        info.get("Name", ""),           # Name
+        generate_step_line(step_line),  # If the step line contains a long list of references, truncate the list and keep everything else
+        natural_key(info.get("Name")),  # Not displayed. Sorts the Name column
+        len(encoded)                    # Not inserted. Added to the step line bytes of the type
+    ], [(entity.id(), dst, index) for dst, index in references(encoded)]
+
+# The step line of an ifcopenshell entity written like step_row writes the original one.
+# str(entity) does not escape quotes in strings, so 'it''s (x)' would come out as 'it's (x)' and cut the string short
+# for references() and property_value(). Older versions without to_string() are left with that
+def instance_line(entity):
+    try:
+        step_line = entity.to_string()
+    except AttributeError:
+        return str(entity)
+    head = INSTANCE_HEAD.match(step_line)
+    return f"#{entity.id()}={entity.is_a()}{step_line[head.end():]}" if head else step_line
+
+# Build the same row for an entity of a StepModel from its original step line
+def step_row(model, step_id):
+    raw = model.step_index.raw(step_id)
+    step_line = raw.decode("utf-8", errors="replace")
+    head = INSTANCE_HEAD.match(step_line)
+    ifc_type, names, _ = model.declaration(head.group(2).upper())
+
+    # Only parse as far as GlobalId and Name so instances with huge lists stay cheap
+    wanted = {name: names.index(name) for name in ("GlobalId", "Name") if name in names}
+    info = {}
+    if wanted:
+        attributes = parse_instance(step_line, limit=max(wanted.values()) + 1)[2]
+        info = {name: attributes[i] for name, i in wanted.items() if i < len(attributes)}
+    return [
+        step_id,
+        ifc_type,
+        info.get("GlobalId", ""),
+        info.get("Name", ""),
+        generate_step_line(f"#{step_id}={ifc_type}{step_line[head.end():].rstrip(';')}"), # Written the way ifcopenshell writes it
+        natural_key(info.get("Name")),
+        len(raw.rstrip(b";"))  # Without the ; that instance_line leaves out
+    ], [(step_id, dst, index) for dst, index in references(raw)]
+
+# Sort key that orders the numbers in a name by value so B-12 comes before B-112
+# Every run of digits is replaced by its length and the digits without leading zeros,
+# so a longer number always sorts after a shorter one. Case is ignored
+def natural_key(name):
+    if not isinstance(name, str):
+        return ""
+
+    def replacer(match):
+        digits = match.group().lstrip("0") or "0"
+        return f"{len(digits):02d}{digits}"
+
+    return DIGITS.sub(replacer, name.casefold())
+
+# If the step line contains a long list of references, truncate it to lighten the load on the middle view
+# Only the first max_refs references are split off so lists with 100k references are not split into 100k strings
+def generate_step_line(step_line, max_refs=2):
+    if len(step_line) < 200:
+        return step_line
+
+    def replacer(match):
+        refs = match.group(1).split(',', max_refs)
+        truncated = [r.strip() for r in refs[:max_refs]]
+        removed_count = match.group(1).count(',') + 1 - max_refs
+        if removed_count > 0:
+            return f"({','.join(truncated)}...+{removed_count} more)"
+        else:
+            return f"({','.join(truncated)})"
+
+    return re.sub(r'\((#\d+(?:,\s*#\d+)*)\)', replacer, step_line, count=1)
+
+_db_paths = set() # Databases of every DBWorker not deleted yet. Paths rather than workers so no worker
+                  # and its model is kept alive until the program closes
+
+def remove_db_files(db_path):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        except OSError as e: # Still open somewhere
+            print(f"Unable to delete {db_path + suffix}\n{e}")
+            return
+    _db_paths.discard(db_path)
+
+@atexit.register
+def remove_all_db_files():
+    for db_path in list(_db_paths):
+        remove_db_files(db_path)
+
+# The worker processes used by DBWorker.parallel_row_chunks each keep their own copy of the model
+_extraction_model = None
+_extraction_entities = None
+
+def init_extraction_worker(file_path):
+    global _extraction_model, _extraction_entities
+    _extraction_model = ifcopenshell.open(file_path)
+    _extraction_entities = sorted(_extraction_model, key=lambda entity: entity.id())
+
+def extract_rows(bounds):
+    start, stop = bounds
+    rows = [entity_row(entity) for entity in _extraction_entities[start:stop]]
+    return [row for row, _ in rows], [ref for _, refs in rows for ref in refs]
+
+# The file is only memory-mapped. The locations of the step lines come with every shard
+def init_step_extraction_worker(file_path):
+    global _extraction_model
+    _extraction_model = StepModel(StepIndex(file_path))
+
+def extract_step_rows(shard):
+    step_index = _extraction_model.step_index
+    step_index.ids, step_index.offsets, step_index.lengths = shard
+    rows = [step_row(_extraction_model, step_id) for step_id in step_index.ids]
+    return [row for row, _ in rows], [ref for _, refs in rows for ref in refs]
+
+# Read the first column of every row into a typed array
+# The rows are read in chunks so a Python int is never kept for every row
+def read_ids(rows):
+    ids = array("q")
+    while chunk := list(itertools.islice(rows, ROW_ID_CHUNK)):
+        ids.extend([row[0] for row in chunk])
+    return ids
+
+# Estimated memory used by the rows of a page, counting the tuples and every value in them
+# Values shared between rows like the type names are counted once per row so this errs on the high side
+def rows_bytes(rows):
+    return sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in rows if row is not None)
+
+# Bind arrays of ids as carrays so queries can use them with "id IN carray(?)"
+# A function in params is called first to get its array. FilterQuery passes short term lookups that way
+def bind_params(params):
+    return [apsw.carray(param() if callable(param) else param) if not isinstance(param, (str, int, float)) else param
+            for param in params]
+
+# (value_text, value_num) of the NominalValue of an IfcPropertySingleValue
+# Numbers are kept in value_num so they can be compared as numbers, anything else as text in value_text
+def property_value(step_line):
+    instance = parse_instance(step_line, limit=3)
+    value = instance[2][2] if instance and len(instance[2]) > 2 else None
+    if isinstance(value, TypedValue):
+        value = value.wrappedValue
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return None, value
+    if value is None:
+        return None, None
+    return str(value), None
+
+# {Ifc Type: (count, step line bytes)} of every type in the database
+# DBWorker adds them up while inserting the rows so nothing is counted when a cached database is opened
+def type_stats(db):
+    return {name: (count, size) for name, count, size in db.execute("SELECT name, count, bytes FROM types")}
+
+# The entities referencing step_id, in ascending order, a page at a time
+# after: The last entity of the previous page. The index on dst starts right after it rather than skipping the earlier pages
+def inverse_references(db, step_id, after=0, limit=REFERENCE_PAGE_SIZE):
+    return read_ids(db.execute("SELECT DISTINCT src FROM refs WHERE dst = ? AND src > ? ORDER BY src LIMIT ?",
+                               (step_id, after, limit)))
+
+# The entities step_id references, in ascending order, a page at a time like inverse_references
+def forward_references(db, step_id, after=0, limit=REFERENCE_PAGE_SIZE):
+    return read_ids(db.execute("SELECT DISTINCT dst FROM refs WHERE src = ? AND dst > ? ORDER BY dst LIMIT ?",
+                               (step_id, after, limit)))
+
+# Number of entities referencing step_id
+def reference_count(db, step_id):
+    return db.execute("SELECT count(DISTINCT src) FROM refs WHERE dst = ?", (step_id,)).fetchone()[0]
+
+# Number of entities step_id references
+def forward_count(db, step_id):
+    return db.execute("SELECT count(DISTINCT dst) FROM refs WHERE src = ?", (step_id,)).fetchone()[0]
+
+# Type name -> id for every declaration of a schema, numbered in alphabetical order
+# so sorting by type_id sorts by the name of the type
+def type_ids(schema):
+    try:
+        declarations = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema).declarations()
+    except Exception as e:
+        print(f"Unable to number the types of {schema}\n{e}")
+        return {}
+    return {name: i for i, name in enumerate(sorted(declaration.name() for declaration in declarations))}
+
+# (id, Ifc Type, GUID, Name, start of the step line) of the entities in step_ids that are in the database
+def read_summaries(db, step_ids, preview_length=SUMMARY_PREVIEW_LENGTH):
+    return db.execute('SELECT id, "Ifc Type", "GUID", "Name", substr("STEP Line", 1, ?) FROM base_entities '
+                      'WHERE id IN carray(?)', (preview_length, apsw.carray(array("q", step_ids))))
+
+# The EntitySummaries class keeps what the reference trees show of an entity: (Ifc Type, GUID, Name, start of the step line).
+# The trees hand it every page of rows before drawing them so the summaries are read from base_entities with one query
+# and a label never decodes the attributes of an entity. The least recently used are dropped beyond size entities.
+# A ReferenceWorker can read them along with the references and hand them over with add().
+class EntitySummaries:
+    def __init__(self, db, size=SUMMARY_CACHE_SIZE, preview_length=SUMMARY_PREVIEW_LENGTH):
+        self.db = db
+        self.size = max(1, size)
+        self.preview_length = preview_length
+        self._summaries = OrderedDict() # STEP ID -> summary, least recently used first
+
+    # Read the summaries of the step_ids not kept yet
+    def fetch(self, step_ids):
+        missing = array("q", (step_id for step_id in step_ids if step_id not in self._summaries))
+        if not missing:
+            return
+        try:
+            self.add(read_summaries(self.db, missing, self.preview_length))
+        except apsw.BusyError: # DBWorker is checkpointing. Read again when a label asks for it
+            pass
 
-        return re.sub(r'\((#\d+(?:,\s*#\d+)*)\)', replacer, step_line, count=1)
+    # rows: (id, Ifc Type, GUID, Name, start of the step line) as read by read_summaries
+    def add(self, rows):
+        for step_id, *summary in rows:
+            self._summaries[step_id] = tuple(summary)
+        while len(self._summaries) > self.size:
+            self._summaries.popitem(last=False)
+
+    # None if step_id is not in the database yet
+    def get(self, step_id):
+        summary = self._summaries.get(step_id)
+        if summary is None:
+            self.fetch((step_id,))
+            return self._summaries.get(step_id)
+        self._summaries.move_to_end(step_id)
+        return summary
+
+    def clear(self):
+        self._summaries.clear()
+
+# The RowQueryWorker class runs the query behind a filter or sort of the middle view in the background.
+# It reads from its own connection and cancel() interrupts the query so a newer filter does not have to wait for it.
+# rows_ready is only emitted for queries that were not cancelled.
+# The arrays and lookups in params are bound by bind_params so any lookup runs here rather than in the main thread.
+class RowQueryWorker(QThread):
+    rows_ready = Signal(object) # array("q") of row ids
+
+    def __init__(self, db_path, query, params=()):
+        super().__init__()
+        self.db_path = db_path
+        self.query = query
+        self.params = params
+        self.conn = None
+
+    def cancel(self):
+        self.requestInterruption()
+        try:
+            if self.conn:
+                self.conn.interrupt()
+        except apsw.ConnectionClosedError:
+            pass
+
+    def run(self):
+        try:
+            self.conn = connect(self.db_path)
+            row_ids = read_ids(self.conn.execute(self.query, bind_params(self.params)))
+        except apsw.InterruptError:
+            return
+        except Exception as e:
+            print(f"Failed to query rows\n{e}")
+            return
+        finally:
+            conn, self.conn = self.conn, None
+            if conn:
+                conn.close()
+
+        if not self.isInterruptionRequested():
+            self.rows_ready.emit(row_ids)
+
+# The ReferenceWorker class reads a page of the entities referencing step_id for the left view in the background.
+# The number of references is counted first so the view can show it while the page streams in, in ascending chunks.
+# It reads from its own connection like RowQueryWorker and cancel() stops it when another entity is selected.
+# With preview_length, the summaries of every chunk are read here too so the view can label the rows without a query.
+class ReferenceWorker(QThread):
+    counted = Signal(int)            # Number of entities referencing step_id, only when asked for
+    summaries_ready = Signal(object) # Rows of read_summaries for the next chunk, only with preview_length
+    chunk_ready = Signal(object)     # array("q") of up to chunk_size STEP IDs following the previous chunk
+
+    def __init__(self, db_path, step_id, after=0, limit=REFERENCE_PAGE_SIZE, count=True, chunk_size=REFERENCE_CHUNK_SIZE,
+                 preview_length=None):
+        super().__init__()
+        self.db_path = db_path
+        self.step_id = step_id
+        self.after = after
+        self.limit = limit
+        self.count = count
+        self.chunk_size = max(1, chunk_size)
+        self.preview_length = preview_length
+        self.conn = None
+
+    def cancel(self):
+        self.requestInterruption()
+        try:
+            if self.conn:
+                self.conn.interrupt()
+        except apsw.ConnectionClosedError:
+            pass
+
+    def run(self):
+        try:
+            self.conn = connect(self.db_path)
+            if self.count:
+                total = reference_count(self.conn, self.step_id)
+                if self.isInterruptionRequested():
+                    return
+                self.counted.emit(total)
+
+            after, remaining = self.after, self.limit
+            while remaining > 0 and not self.isInterruptionRequested():
+                step_ids = inverse_references(self.conn, self.step_id, after, min(self.chunk_size, remaining))
+                if not step_ids or self.isInterruptionRequested():
+                    return
+                if self.preview_length is not None:
+                    summaries = list(read_summaries(self.conn, step_ids, self.preview_length))
+                    if self.isInterruptionRequested():
+                        return
+                    self.summaries_ready.emit(summaries)
+                self.chunk_ready.emit(step_ids)
+                if len(step_ids) < min(self.chunk_size, remaining):
+                    return
+                after, remaining = step_ids[-1], remaining - len(step_ids)
+        except apsw.InterruptError:
+            return
+        except Exception as e:
+            print(f"Failed to read the references of #{self.step_id}\n{e}")
+            return
+        finally:
+            conn, self.conn = self.conn, None
+            if conn:
+                conn.close()
+
+_running_queries = set() # Keep every RowQueryWorker and ShortTermIndexWorker alive until its thread ends,
+                         # even after its model is gone
+
+# The ShortTermIndexWorker class builds the ShortTermIndex of a database in the background
+class ShortTermIndexWorker(QThread):
+    index_ready = Signal(object) # ShortTermIndex
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+
+    def run(self):
+        try:
+            conn = connect(self.db_path)
+            try:
+                rows = conn.execute('SELECT id, "Name", "GUID" FROM entities ORDER BY id')
+                index = ShortTermIndex().build(rows, self.isInterruptionRequested)
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Failed to build the short term index\n{e}")
+            return
+
+        if index is not None and not self.isInterruptionRequested():
+            self.index_ready.emit(index)
 
 # The SQLEntityTableModel class serves as the backend for the middle view.
-# Previously, it inserted the entities into the database. Now, it is only created
-# after the background thread is done inserting into the database.
+# Previously, it inserted the entities into the database. Now, it is created
+# as soon as the background thread commits the first chunk of rows and grows
+# as the remaining chunks are committed. Filtering and sorting are only available
+# once the background thread is done building the filter index.
+# Rows are fetched a page at a time and the most recently used pages are kept in memory.
+# The pages belong to the model and are dropped whenever the rows change and when the model is closed.
+# cache_stats counts hits, misses and evictions and estimates their size so the page and cache sizes can be tuned.
+# The page after (or before) the one being drawn is fetched once the view is idle so scrolling rarely waits for a query.
+# Filtering and sorting run in a RowQueryWorker. The rows on display are only swapped once the new ones are ready
+# and a newer filter or sort cancels the one still running.
+# The rows of recent filters and sorts are kept in ascending order, least recently used first,
+# so going back to an earlier filter or sorting by a column again, in either direction, needs no query.
+# A filter that narrows down a kept one, like IfcBea after IfcBe, is only checked against the rows found for it.
+# Filtering starts as soon as the rows are sortable. Until DBWorker has built the filter index,
+# text is only matched against the start of types and GUIDs (see FilterQuery).
+# Once the rows are in, a ShortTermIndex of the names and GUIDs is built for text too short for the filter index.
 class SqlEntityTableModel(QAbstractTableModel):
     row_count_changed = Signal(int)
+    query_started = Signal() # A filter or sort is running in the background
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, loading=False, text_index=True, page_size=PAGE_SIZE, cache_pages=CACHE_PAGES,
+                 result_cache_mb=RESULT_CACHE_MB, log_cache_stats=LOG_CACHE_STATS):
         super().__init__()
-        self.db = apsw.Connection(db_path)
+        self.db_path = db_path
+        self.db = connect(db_path)
+        self.db.set_busy_timeout(BUSY_TIMEOUT_MS) # Wait for DBWorker to finish a checkpoint before reading
+        self._query_worker = None
+
+        self.loading = loading # True while DBWorker is still inserting rows
+        self.text_index = text_index # False until DBWorker has built the filter index
+        self.short_index = None # ShortTermIndex once it is built
+        self._index_worker = None
+
+        # Page cache
+        self.page_size = max(1, page_size)
+        self.cache_pages = max(2, cache_pages) # Room for the page being drawn and the prefetched one
+        self._pages = OrderedDict() # page number -> rows, least recently used first
+        self._last_page = 0
+        self._current_page = None # The page of _last_page
+        self._prefetch_page = None
+        self._prefetch_pending = False
+        self._page_bytes = {} # page number -> estimated size of its rows
+        self.hits = 0       # Rows served from a cached page
+        self.misses = 0     # Rows that needed a page to be fetched
+        self.prefetches = 0 # Pages fetched ahead of the view
+        self.evictions = 0  # Pages dropped to make room for another
+        self.log_cache_stats = log_cache_stats
+
+        # Result cache
+        self.result_cache_bytes = max(0, result_cache_mb) * 1024 ** 2
+        self._results = OrderedDict() # (filter, column) -> ids in ascending order, least recently used first
+        self._results_bytes = 0
+        self.result_hits = 0  # Filters and sorts served from the result cache
+        self.refinements = 0  # Filters only checked against the rows of an earlier one
 
         # Default filter
         self._filter = ""
-        self._row_ids = []
+        self._types = None # Ifc Type -> type id of every type in the database for type filters
+        self._properties = None # Whether the properties table has been built for pset: and prop: filters
+        self._row_ids = array("q") # STEP IDs of the rows in the order they are displayed. 8 bytes per row
         self._sort_column = "STEP ID" # Sort by step id
         self._sort_order = "ASC"
 
         self._load_rows()
+        if not loading:
+            self._build_short_index()
 
-    # Display the entities contained in the database
-    # Optionally filter and sort by conditions provided by the user
-    def _load_rows(self):
+    # Append the rows DBWorker committed since the last call
+    # While loading, the rows are always sorted by STEP ID and DBWorker inserts in the same order
+    def append_committed_rows(self):
+        last_id = self._row_ids[-1] if self._row_ids else -1
+        new_ids = read_ids(self.db.execute("SELECT id FROM entities WHERE id > ? ORDER BY id", (last_id,)))
+        if not new_ids:
+            return
+
+        self.beginInsertRows(QModelIndex(), self._row_count, self._row_count + len(new_ids) - 1)
+        self._drop_page(self._row_count // self.page_size) # The last page is no longer complete
+        self._current_page = None
+        self._row_ids.extend(new_ids)
+        self._row_count = len(self._row_ids)
+        self.endInsertRows()
+        self.row_count_changed.emit(self._row_count)
+
+    # Called once DBWorker has inserted every row and built the sort indexes
+    def finish_loading(self):
+        self.loading = False
+        self._build_short_index()
+        total = self.db.execute("SELECT count(*) FROM entities").fetchone()[0]
+        if total == self._row_count:
+            self._remember_result((self._filter, self._sort_column), self._sort_order, self._row_ids)
+            return
+
+        # Some rows were not inserted in STEP ID order so they were never appended
+        self.beginResetModel()
+        self._load_rows()
+        self._clear_pages()
+        self.endResetModel()
+        self._clear_results()
+
+    # Called once DBWorker has built the filter index and the properties table
+    # The text of the current filter is looked for again now that it can be found anywhere in a row
+    def finish_text_index(self):
+        self.text_index = True
+        self._properties = None
+        self._filter_changed_meaning()
+
+    def _build_short_index(self):
+        worker = ShortTermIndexWorker(self.db_path)
+        worker.index_ready.connect(self._short_index_ready)
+        worker.finished.connect(lambda: _running_queries.discard(worker))
+        _running_queries.add(worker)
+        self._index_worker = worker
+        worker.start()
+
+    @Slot(object)
+    def _short_index_ready(self, index):
+        if self.sender() is not self._index_worker: # Closed just before it finished
+            return
+        self._index_worker = None
+        self.short_index = index
+        self._filter_changed_meaning()
+
+    # Drop the kept results of every filter and filter again
+    # for when a new index changes what the text of a filter finds
+    def _filter_changed_meaning(self):
+        for key in [key for key in self._results if key[0]]:
+            self._results_bytes -= self._results[key].itemsize * len(self._results[key])
+            del self._results[key]
         if self._filter:
-            query = f"""
-                SELECT rowid FROM fts_entities
-                WHERE fts_entities MATCH '"{self._filter}"'
-                ORDER BY "{self._sort_column}" {self._sort_order}
-            """
-            rows = self.db.execute(query)
-        else:
-            query = f"""
-                SELECT id FROM base_entities
-                ORDER BY "{self._sort_column}" {self._sort_order}
-            """
-            rows = self.db.execute(query)
+            self._request_rows()
 
-        self._row_ids = [row[0] for row in rows]
+    def close(self):
+        if self._index_worker:
+            self._index_worker.index_ready.disconnect(self._short_index_ready)
+            self._index_worker.requestInterruption()
+            self._index_worker = None
+        self.short_index = None
+        self._cancel_query()
+        self._clear_pages() # Free the rows even if something still holds on to the model
+        self._clear_results()
+        self.db.close()
+
+    # The query and parameters for the ids of the rows to display
+    # Optionally filter and sort by conditions provided by the user. See FilterQuery for the filter syntax
+    # candidates: The ids of an earlier result the filter only needs to be checked against
+    def _rows_query(self, candidates=None):
+        order = f"{SORT_KEYS[self._sort_column]} {self._sort_order}, id {self._sort_order}"
+        if self._filter:
+            if self._types is None:
+                self._types = dict(self.db.execute("SELECT name, id FROM types"))
+            if self._properties is None:
+                self._properties = self.db.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'properties'").fetchone() is not None
+            where, params = compile_filter(self._filter, self._types, candidates=candidates,
+                                           text_index=self.text_index, short_index=self.short_index,
+                                           properties=self._properties)
+            if candidates is not None:
+                where = f"id IN carray(?) AND {where}"
+                params = [candidates] + params
+            return f"SELECT id FROM base_entities WHERE {where} ORDER BY {order}", params
+        return f"SELECT id FROM base_entities ORDER BY {order}", ()
+
+    # Display the entities contained in the database
+    def _load_rows(self):
+        query, params = self._rows_query()
+        self._row_ids = read_ids(self.db.execute(query, bind_params(params)))
         self._row_count = len(self._row_ids)
         self.row_count_changed.emit(self._row_count)
+        if not self.loading:
+            self._remember_result((self._filter, self._sort_column), self._sort_order, self._row_ids)
+
+    # Keep the rows of a filter and sort in ascending order and evict the least recently used ones
+    def _remember_result(self, key, sort_order, row_ids):
+        size = row_ids.itemsize * len(row_ids)
+        if size > self.result_cache_bytes:
+            return
+        if key in self._results:
+            self._results_bytes -= self._results[key].itemsize * len(self._results[key])
+        self._results[key] = row_ids if sort_order == "ASC" else row_ids[::-1]
+        self._results.move_to_end(key)
+        self._results_bytes += size
+        while self._results_bytes > self.result_cache_bytes:
+            _, evicted = self._results.popitem(last=False)
+            self._results_bytes -= evicted.itemsize * len(evicted)
+
+    def _clear_results(self):
+        self._results.clear()
+        self._results_bytes = 0
+
+    # The smallest kept result the current filter narrows down, if it is small enough to be worth checking row by row
+    def _refinable_result(self):
+        if not self._filter or not self.text_index: # Text does not mean the same thing without the filter index
+            return None
+        query = FilterQuery(self._filter)
+        best = None
+        for (filter_text, _), row_ids in self._results.items():
+            if (filter_text and len(row_ids) <= REFINE_ROW_LIMIT and (best is None or len(row_ids) < len(best))
+                    and query.refines(filter_text)):
+                best = row_ids
+        return best
+
+    # Query the rows in the background and replace the current rows once they are ready
+    def _request_rows(self):
+        self._cancel_query()
+
+        key = (self._filter, self._sort_column)
+        row_ids = self._results.get(key)
+        if row_ids is not None:
+            self._results.move_to_end(key)
+            self.result_hits += 1
+            self._show_rows(row_ids if self._sort_order == "ASC" else row_ids[::-1])
+            return
+
+        candidates = self._refinable_result()
+        if candidates is not None:
+            self.refinements += 1
+        worker = RowQueryWorker(self.db_path, *self._rows_query(candidates))
+        worker.key = key
+        worker.sort_order = self._sort_order
+        worker.rows_ready.connect(self._rows_ready)
+        worker.finished.connect(lambda: _running_queries.discard(worker))
+        _running_queries.add(worker)
+        self._query_worker = worker
+        worker.start()
+        self.query_started.emit()
+
+    def _cancel_query(self):
+        if self._query_worker:
+            self._query_worker.rows_ready.disconnect(self._rows_ready)
+            self._query_worker.cancel()
+            self._query_worker = None
+
+    @Slot(object)
+    def _rows_ready(self, row_ids):
+        worker = self.sender()
+        if worker is not self._query_worker: # Finished just before it was cancelled
+            return
+        self._query_worker = None
+
+        self._remember_result(worker.key, worker.sort_order, row_ids)
+        self._show_rows(row_ids)
+
+    # Swap the rows on display
+    def _show_rows(self, row_ids):
+        self.beginResetModel()
+        self._row_ids = row_ids
+        self._row_count = len(row_ids)
+        self._clear_pages()
+        self.endResetModel()
+        self.row_count_changed.emit(self._row_count)
 
     # Get the filter text inputted by the user and display the data again
     def set_filter(self, filter_text):
-        self._filter = filter_text.strip()
-        self._load_rows()
-        self._get_row.cache_clear()
-        self.layoutChanged.emit()
+        filter_text = filter_text.strip()
+        if filter_text == self._filter:
+            return # Already filtered or filtering this way
+        self._filter = filter_text
+        self._request_rows()
 
     # Sorts the database view
     def sort(self, column, order):
+        sort_order = "ASC" if order == Qt.AscendingOrder else "DESC"
+        if (COLUMNS[column], sort_order) == (self._sort_column, self._sort_order):
+            return # Already sorted this way
         self._sort_column = COLUMNS[column]
-        if order == Qt.AscendingOrder:
-            self._sort_order = "ASC"
-        else:
-            self._sort_order = "DESC"
-        self._load_rows()
-        self._get_row.cache_clear()
-        self.layoutChanged.emit()
+        self._sort_order = sort_order
+        self._request_rows()
+
+    # Page cache counters for tuning the page and cache sizes
+    def cache_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetches": self.prefetches,
+            "evictions": self.evictions,
+            "pages": len(self._pages),
+            "page_bytes": sum(self._page_bytes.values()),
+            "page_size": self.page_size,
+            "cache_pages": self.cache_pages,
+            "result_hits": self.result_hits,
+            "refinements": self.refinements,
+            "results": len(self._results),
+            "result_bytes": self._results_bytes
+        }
 
     def rowCount(self, parent=QModelIndex()):
         return self._row_count
@@ -202,7 +1112,10 @@ class SqlEntityTableModel(QAbstractTableModel):
         if not index.isValid() or role != Qt.DisplayRole:
             return None
 
-        row = self._get_row(index.row())
+        try:
+            row = self._get_row(index.row())
+        except apsw.BusyError: # DBWorker is checkpointing. The row is drawn on the next repaint
+            return None
         if not row:
             return None
 
@@ -213,14 +1126,77 @@ class SqlEntityTableModel(QAbstractTableModel):
 
         return row[col]
 
-    # Gets a row from the database by id
-    # TODO: The cache probably helps but we should get the rows in batches instead of individually
-    @functools.lru_cache(maxsize=4096) # _get_row is called many times so use a cache to optimize performance
+    # Gets a row from the page cache, fetching its page if needed
     def _get_row(self, index):
-        if index >= len(self._row_ids):
+        if index >= self._row_count:
             return None
 
-        rowid = self._row_ids[index]
-        cursor = self.db.cursor()
-        cursor.execute(f"SELECT {COLUMNS_SQL} FROM base_entities WHERE id = ?", (rowid,))
-        return cursor.fetchone()
\ No newline at end of file
+        page_number, offset = divmod(index, self.page_size)
+        if page_number == self._last_page and self._current_page is not None: # Every cell of a row asks for the same page
+            self.hits += 1
+            return self._current_page[offset]
+
+        page = self._pages.get(page_number)
+        if page is None:
+            self.misses += 1
+            page = self._fetch_page(page_number)
+            if self.log_cache_stats:
+                self._log_cache_stats()
+        else:
+            self.hits += 1
+            self._pages.move_to_end(page_number)
+
+        # Prefetch the next page in the direction the view is scrolling
+        if page_number != self._last_page:
+            self._prefetch_page = page_number + (1 if page_number > self._last_page else -1)
+            if not self._prefetch_pending:
+                self._prefetch_pending = True
+                QTimer.singleShot(0, self._prefetch)
+        self._last_page = page_number
+        self._current_page = page
+
+        return page[offset]
+
+    # Get every row of a page with a single query
+    def _fetch_page(self, page_number):
+        start = page_number * self.page_size
+        ids = self._row_ids[start:start + self.page_size]
+        rows = {row[0]: row[1:] for row in self.db.execute(
+            f"SELECT id, {COLUMNS_SQL} FROM base_entities WHERE id IN carray(?)", (apsw.carray(ids),))}
+        page = [rows.get(rowid) for rowid in ids] # In the order of the view
+
+        self._pages[page_number] = page
+        self._page_bytes[page_number] = rows_bytes(page)
+        while len(self._pages) > self.cache_pages:
+            self._drop_page(next(iter(self._pages)))
+            self.evictions += 1
+        return page
+
+    def _drop_page(self, page_number):
+        self._pages.pop(page_number, None)
+        self._page_bytes.pop(page_number, None)
+
+    def _prefetch(self):
+        self._prefetch_pending = False
+        page_number = self._prefetch_page
+        if page_number < 0 or page_number * self.page_size >= len(self._row_ids) or page_number in self._pages:
+            return
+        try:
+            self._fetch_page(page_number)
+            self.prefetches += 1
+        except (apsw.BusyError, apsw.ConnectionClosedError): # Fetched when the view gets there instead
+            pass
+
+    def _log_cache_stats(self):
+        stats = self.cache_stats()
+        lookups = stats["hits"] + stats["misses"]
+        print(f"Page cache: {stats['hits'] / lookups:.1%} hits of {lookups}, {stats['misses']} misses, "
+              f"{stats['prefetches']} prefetches, {stats['evictions']} evictions, "
+              f"{stats['pages']}/{stats['cache_pages']} pages of {stats['page_size']} rows, "
+              f"{stats['page_bytes'] / 1024 ** 2:.1f} MB")
+
+    def _clear_pages(self):
+        self._pages.clear()
+        self._page_bytes.clear()
+        self._last_page = 0
+        self._current_page = None
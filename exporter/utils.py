@@ -218,8 +218,11 @@ def check_references(model):
 # CONTEXT MENU
 # =====================
 
-def copy_step_line(entity):
-    QApplication.clipboard().setText(str(entity))
+# Copy the original bytes from the file when a StepIndex is available
+# rather than having ifcopenshell serialize the entity again
+def copy_step_line(entity, step_index=None):
+    step_line = step_index.line(entity.id()) if step_index else None
+    QApplication.clipboard().setText(step_line or str(entity))
 
 def copy_step_id(entity):
     QApplication.clipboard().setText('#' + str(entity.id()))
@@ -1,13 +1,36 @@
 import os
+import json
 CONFIG_PATH = os.path.join(os.path.dirname(__file__),"config.json") # Save the recent files list
 
-from tui import language_manager
+from tui import language_manager, TLabel, TPushButton, TCheckBox
+from strings import OPTIONS_CACHE_KEYS, OPTIONS_INDEXING_KEYS
 
+from PySide6.QtCore import QCoreApplication
 from PySide6.QtWidgets import (
     QLabel, QVBoxLayout, QHBoxLayout,
-    QDialog, QComboBox
+    QDialog, QComboBox, QSpinBox
 )
 
+# Read the whole config file
+def load_config():
+    if os.path.exists(CONFIG_PATH):
+        try:
+            with open(CONFIG_PATH, "r") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+    return {}
+
+# Update a single key in the config file and keep everything else
+def save_config_value(key, value):
+    try:
+        data = load_config()
+        data[key] = value
+        with open(CONFIG_PATH, "w") as f:
+            json.dump(data, f, indent=4)
+    except Exception as e:
+        print("Error saving config:", e)
+
 class OptionsDialog(QDialog):
     def __init__(self, title="Options"):
         super().__init__()
@@ -17,6 +40,8 @@ class OptionsDialog(QDialog):
         self.main_layout = QVBoxLayout(self)
 
         self.add_language_selector()
+        self.add_cache_settings()
+        self.add_indexing_settings()
     
     def add_language_selector(self):
         self.language_selector = QComboBox()
@@ -40,4 +65,61 @@ class OptionsDialog(QDialog):
         language_code = self.language_selector.currentData()
         print(f"Switching to {language_code}")
         language_manager.current_language = language_code
-        language_manager.language_changed.emit(language_code) # notify the ui that the language changed
\ No newline at end of file
+        language_manager.language_changed.emit(language_code) # notify the ui that the language changed
+
+    # Entity cache usage, size limit and a button for clearing it
+    def add_cache_settings(self):
+        from cache import entity_cache, DEFAULT_CACHE_LIMIT_GB # cache.py reads the config through this module
+
+        # "Entity Cache: {size} MB"
+        self.cache_label = TLabel(OPTIONS_CACHE_KEYS[0], context="Options Dialog",
+                                  format_args={"size": self.cache_size_mb(entity_cache)})
+
+        # "Limit (GB)"
+        self.cache_limit_label = TLabel(OPTIONS_CACHE_KEYS[1], context="Options Dialog")
+        self.cache_limit_selector = QSpinBox()
+        self.cache_limit_selector.setRange(1, 1024)
+        self.cache_limit_selector.setValue(load_config().get("cache_limit_gb", DEFAULT_CACHE_LIMIT_GB))
+        self.cache_limit_selector.valueChanged.connect(lambda value: save_config_value("cache_limit_gb", value))
+
+        # "Clear Cache"
+        self.clear_cache_button = TPushButton(OPTIONS_CACHE_KEYS[2], context="Options Dialog",
+                                              clicked=self.clear_cache, clicked_args=entity_cache)
+
+        self.cache_layout = QHBoxLayout()
+        self.cache_layout.addWidget(self.cache_label)
+        self.cache_layout.addWidget(self.cache_limit_label)
+        self.cache_layout.addWidget(self.cache_limit_selector)
+        self.cache_layout.addWidget(self.clear_cache_button)
+        self.main_layout.addLayout(self.cache_layout)
+
+    def cache_size_mb(self, cache):
+        return round(cache.total_bytes() / 1024 ** 2, 1)
+
+    def clear_cache(self, cache):
+        cache.clear()
+        self.cache_label.setText(OPTIONS_CACHE_KEYS[0], format_args={"size": self.cache_size_mb(cache)})
+
+    # Number of processes DBWorker uses to extract rows and whether it builds the properties table
+    def add_indexing_settings(self):
+        from db import INDEX_PROPERTIES # db.py imports this module through cache.py
+
+        # "Indexing Processes"
+        self.processes_label = TLabel(OPTIONS_INDEXING_KEYS[0], context="Options Dialog")
+        # "Each process loads its own copy of the model"
+        self.processes_label.setToolTip(QCoreApplication.translate("Options Dialog", OPTIONS_INDEXING_KEYS[1]))
+        self.processes_selector = QSpinBox()
+        self.processes_selector.setRange(1, os.cpu_count() or 1)
+        self.processes_selector.setValue(load_config().get("db_worker_processes", 1))
+        self.processes_selector.valueChanged.connect(lambda value: save_config_value("db_worker_processes", value))
+
+        self.processes_layout = QHBoxLayout()
+        self.processes_layout.addWidget(self.processes_label)
+        self.processes_layout.addWidget(self.processes_selector)
+
+        # "Index Properties"
+        self.properties_checkbox = TCheckBox(OPTIONS_INDEXING_KEYS[2], OPTIONS_INDEXING_KEYS[3], context="Options Dialog")
+        self.properties_checkbox.setChecked(load_config().get("index_properties", INDEX_PROPERTIES))
+        self.properties_checkbox.toggled.connect(lambda checked: save_config_value("index_properties", checked))
+        self.processes_layout.addWidget(self.properties_checkbox)
+        self.main_layout.addLayout(self.processes_layout)
@@ -0,0 +1,409 @@
+import re
+from fnmatch import fnmatchcase
+from functools import partial
+from short_index import SHORT_TERM_LENGTH
+
+# Tokens of a filter query like: type:IfcBeam name:B-1* OR NOT line:~"IFCCARTESIANPOINT"
+# A quoted field value can go on after a dot like pset:"Tekla Common".AssemblyMark="B 12"
+QUERY_TOKENS = re.compile(r"""
+     (?P<space>\s+)
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?P<field>(?P<name>[A-Za-z]+):(?P<contains>~)?(?P<value>"(?:[^"]|"")*"(?:\.(?:"(?:[^"]|"")*"?|[^\s()"]+)*)?|"(?:[^"]|"")*"?|[^\s()]*))
+    |(?P<phrase>"(?:[^"]|"")*"?)
+    |(?P<word>[^\s()"]+)
+""", re.VERBOSE)
+
+KEYWORDS = {"AND", "OR", "NOT"} # Only recognised in upper case so "and" can still be searched for
+FTS_COLUMNS = {"GUID", "Name", "STEP Line"} # Columns of fts_entities. Types are matched against the types table instead
+SHORT_TEXT_COLUMNS = {"GUID", "Name"} # Where text too short for the filter index is looked for
+                                      # Nearly every STEP line contains any one or two characters
+MIN_MATCH_LENGTH = 3 # The trigram filter index only holds substrings of 3 characters or more
+LAST_CHAR = "\U0010ffff" # Sorts after any other character so prefix + LAST_CHAR is the end of a prefix range
+PROPERTY_PART = re.compile(r'"(?:[^"]|"")*"?|[^"]+') # Quoted and unquoted parts of "Tekla Common".Weight>500
+PROPERTY_OPERATOR = re.compile(r"<=|>=|!=|=|<|>")
+QUOTED = re.compile(r'"(?:[^"]|"")*"?') # A value that is nothing but text in quotes
+
+# Text inside double quotes with "" standing for a double quote
+def unquote(value):
+    if not value.startswith('"'):
+        return value
+    value = value[1:-1] if len(value) > 1 and value.endswith('"') else value[1:] # The closing quote is optional
+    return value.replace('""', '"')
+
+# Split the value of a pset: or prop: term like "Tekla Common".AssemblyMark=B-12 into (names, operator, value)
+# names are split at the dots outside quotes. Anything inside quotes is taken literally so names can hold spaces,
+# dots and operators. operator and value are None without a comparison
+def split_property(text):
+    if QUOTED.fullmatch(text): # The whole term in quotes like "Tekla Common.AssemblyMark=B-12"
+        parts = [(unquote(text), False)]
+    else:
+        parts = [(part, part.startswith('"')) for part in PROPERTY_PART.findall(text)]
+
+    names, name = [], ""
+    for i, (part, quoted) in enumerate(parts):
+        if quoted:
+            name += unquote(part)
+            continue
+        operator = PROPERTY_OPERATOR.search(part)
+        pieces = part[:operator.start() if operator else len(part)].split(".")
+        name += pieces[0]
+        for piece in pieces[1:]:
+            names.append(name)
+            name = piece
+        if operator:
+            names.append(name)
+            rest = part[operator.end():] + "".join(part for part, _ in parts[i + 1:])
+            return names, operator.group(), unquote(rest)
+    names.append(name)
+    return names, None, None
+
+# A phrase for an fts5 MATCH expression. Anything inside the quotes is taken literally
+def fts_string(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# The characters before the first * or ? of a pattern
+def literal_prefix(pattern):
+    return re.split(r"[*?]", pattern, maxsplit=1)[0]
+
+# The FilterQuery class compiles the text of the filter bar into a WHERE clause on base_entities.
+#   type:IfcBeam           Ifc Type, ignoring case. * and ? are wildcards
+#   name:B-1*              Name, ignoring case. * and ? are wildcards
+#   guid:2O2Fr$*           GUID. * and ? are wildcards
+#   id:1000..2000          STEP ID or a range of them. Either end of the range can be left out
+#   line:IFCCARTESIANPOINT Text anywhere in the STEP line
+#   prop:Weight>500        Entities with a single value property. The value is compared with =, !=, <, <=, > or >=,
+#                          as a number when it is one. Names and text values ignore case. * and ? are wildcards
+#   pset:Tekla*.AssemblyMark=B-12
+#                          The same with the name of the property set before the last dot. pset:Pset_BeamCommon on its own
+#                          finds the entities with that property set. ~ finds the text anywhere in the value
+#   field:~text            Text anywhere in the field
+#   text                   Text anywhere in the row
+# Values with spaces or parentheses go in double quotes. Terms are combined with AND, OR, NOT and parentheses
+# and terms next to each other must all match. Nothing is ever rejected: a term that cannot be read is searched for as text.
+# Values are always passed as parameters. Exact matches and prefixes use the B-tree indexes DBWorker builds
+# and the filter index is only used to find text inside a field.
+# candidates: The STEP IDs of an earlier result the query is only checked against.
+# Text is still matched the same way so narrowing a result down finds the same rows as filtering from scratch,
+# but short_index only tests those rows.
+# With text_index=False, the filter index has not been built yet. Text on its own only finds
+# the types and GUIDs starting with it so the query can still use the B-tree indexes.
+# With properties=False, the properties table has not been built and property terms match nothing.
+# Text of one or two characters is looked up in short_index, a ShortTermIndex, when there is one.
+# Its rows are passed as a function returning their ids in params so the lookup runs along with the query
+# and has to be bound as a carray (see bind_params in db.py).
+class FilterQuery:
+    # Field -> method compiling a condition on that field
+    FIELDS = {
+        "type": "_type_condition",
+        "name": "_name_condition",
+        "guid": "_guid_condition",
+        "id": "_id_condition",
+        "line": "_line_condition",
+        "pset": "_pset_condition",
+        "prop": "_prop_condition",
+    }
+
+    CASE_SENSITIVE = {"guid"} # Fields whose patterns do not ignore case
+    EXACT_FIELDS = {"id", "pset", "prop"} # Fields whose terms only narrow down the exact same term
+    QUOTED_FIELDS = {"pset", "prop"} # Fields whose values are unquoted by their condition since only parts of them may be quoted
+
+    # types: Ifc Type -> type id of every type in the database for matching types regardless of case
+    def __init__(self, text, types=(), candidates=None, text_index=True, short_index=None, properties=True):
+        self.text = text
+        self.types = types
+        self.candidates = candidates
+        self.text_index = text_index
+        self.short_index = short_index
+        self.properties = properties
+        self.params = []
+        self._tokens = [
+            match for match in QUERY_TOKENS.finditer(text)
+            if match.lastgroup != "space"
+        ]
+        self._position = 0
+
+    # Returns (where, params) for "SELECT ... FROM base_entities WHERE {where}"
+    def compile(self):
+        self.params = []
+        self._position = 0
+        conditions = []
+        while self._peek():
+            if self._peek().lastgroup == "close": # Unmatched closing parenthesis
+                self._position += 1
+                continue
+            conditions.append(self._or())
+        return self._join(conditions, "AND") or "1", self.params
+
+    # Whether every row matching this query also matches the query in previous_text,
+    # so this query only has to be checked against the rows found for that one.
+    # Only queries that are nothing but terms next to each other are compared
+    def refines(self, previous_text):
+        terms = self._terms()
+        previous_terms = FilterQuery(previous_text)._terms()
+        if terms is None or previous_terms is None:
+            return False
+        return all(any(implies(term, previous) for term in terms) for previous in previous_terms)
+
+    # The terms of the query as (field, contains, value), field being None for text anywhere in the row
+    # None when the query uses parentheses, OR or NOT
+    def _terms(self):
+        terms = []
+        for token in self._tokens:
+            kind = token.lastgroup
+            if kind in ("open", "close") or token.group() in ("OR", "NOT"):
+                return None
+            if token.group() == "AND":
+                continue
+            if kind == "field":
+                field = token.group("name").lower()
+                value = unquote(token.group("value"))
+                if field in self.FIELDS and value:
+                    contains = bool(token.group("contains")) or field == "line"
+                    if field not in self.CASE_SENSITIVE:
+                        value = value.lower()
+                    terms.append((field, contains, value))
+                    continue
+                terms.append((None, True, token.group().lower()))
+            else:
+                terms.append((None, True, unquote(token.group()).lower()))
+        return terms
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _keyword(self):
+        token = self._peek()
+        if token and token.lastgroup == "word" and token.group() in KEYWORDS:
+            return token.group()
+        return None
+
+    def _join(self, conditions, operator):
+        conditions = [c for c in conditions if c]
+        if len(conditions) < 2:
+            return conditions[0] if conditions else None
+        return "(" + f" {operator} ".join(conditions) + ")"
+
+    def _or(self):
+        conditions = [self._and()]
+        while self._keyword() == "OR":
+            self._position += 1
+            conditions.append(self._and())
+        return self._join(conditions, "OR")
+
+    def _and(self):
+        conditions = []
+        while self._peek() and self._peek().lastgroup != "close" and self._keyword() != "OR":
+            if self._keyword() == "AND":
+                self._position += 1
+                continue
+            conditions.append(self._not())
+        return self._join(conditions, "AND")
+
+    def _not(self):
+        if self._keyword() == "NOT":
+            self._position += 1
+            condition = self._not() if self._peek() else None
+            # IS NOT TRUE keeps the rows where the condition is NULL because the field is empty
+            return f"({condition}) IS NOT TRUE" if condition else None
+        return self._term()
+
+    def _term(self):
+        token = self._peek()
+        self._position += 1
+        kind = token.lastgroup
+
+        if kind == "open":
+            condition = self._or()
+            if self._peek() and self._peek().lastgroup == "close":
+                self._position += 1
+            return condition
+
+        if kind == "field":
+            field = token.group("name").lower()
+            method = self.FIELDS.get(field)
+            value = token.group("value") if field in self.QUOTED_FIELDS else unquote(token.group("value"))
+            if method and value:
+                condition = getattr(self, method)(value, bool(token.group("contains")))
+                if condition:
+                    return condition
+            return self._text(token.group()) # Not a field we know so search for the text
+
+        return self._text(unquote(token.group()))
+
+    def _param(self, value):
+        self.params.append(value)
+        return "?"
+
+    # Text on its own
+    def _text(self, text):
+        if self.text_index or self._short(text) or not text:
+            return self._contains(None, text)
+        type_condition = self._type_condition(text + "*", False)
+        guid_condition = self._pattern("GUID", text + "*")
+        return guid_condition if type_condition == "0" else self._join([type_condition, guid_condition], "OR")
+
+    # Whether text should be looked up in short_index
+    def _short(self, text):
+        return self.short_index is not None and 0 < len(text) <= SHORT_TERM_LENGTH
+
+    # Text of one or two characters in the Name or GUID column, or in either of them when column is None
+    def _short_contains(self, column, text):
+        rows = f"id IN carray({self._param(partial(self.short_index.search, text, self.candidates))})"
+        if column: # short_index does not tell Name and GUID apart
+            return f"({rows} AND {self._like(column, text)})"
+        return rows
+
+    def _like(self, column, text):
+        return f"\"{column}\" LIKE {self._param(f'%{escape_like(text)}%')} ESCAPE '\\'"
+
+    # Text anywhere in a column of fts_entities or anywhere in the row when column is None
+    def _contains(self, column, text):
+        if not text:
+            return None
+        if column is None: # The type is looked for in the types table rather than in every row
+            condition = self._text_contains(None, text) # Parameters are added in the order the conditions are written
+            type_condition = self._type_condition(text, True)
+            return condition if type_condition == "0" else self._join([condition, type_condition], "OR")
+        return self._text_contains(column, text)
+
+    def _text_contains(self, column, text):
+        if column in (None, "Name", "GUID") and self._short(text):
+            return self._short_contains(column, text)
+        if not self.text_index or len(text) < MIN_MATCH_LENGTH: # Scan the table instead of the filter index
+            columns = [column] if column else sorted(FTS_COLUMNS if len(text) >= MIN_MATCH_LENGTH else SHORT_TEXT_COLUMNS)
+            return self._join([self._like(c, text) for c in columns], "OR")
+        match = f"{fts_string(column)} : {fts_string(text)}" if column else fts_string(text)
+        return f"id IN (SELECT rowid FROM fts_entities WHERE fts_entities MATCH {self._param(match)})"
+
+    # A pattern with * and ? wildcards on an indexed column
+    # collate: The collation of the index on the column
+    def _pattern(self, column, pattern, collate=""):
+        prefix = literal_prefix(pattern)
+        if prefix == pattern:
+            return f"\"{column}\" = {self._param(pattern)}{collate}"
+
+        conditions = []
+        if prefix: # Only the rows in the range of the prefix need to be read from the index
+            conditions.append(f"\"{column}\" >= {self._param(prefix)}{collate}")
+            conditions.append(f"\"{column}\" < {self._param(prefix + LAST_CHAR)}{collate}")
+        if pattern != prefix + "*":
+            if collate: # LIKE ignores case like the NOCASE index does
+                like = escape_like(pattern).replace("*", "%").replace("?", "_")
+                conditions.append(f"\"{column}\" LIKE {self._param(like)} ESCAPE '\\'")
+            else:
+                glob = re.sub(r"[\[\]]", lambda m: f"[{m.group()}]", pattern)
+                conditions.append(f"\"{column}\" GLOB {self._param(glob)}")
+        return self._join(conditions, "AND") or f"\"{column}\" IS NOT NULL" # Only * so anything matches
+
+    def _type_condition(self, value, contains):
+        if not self.types:
+            return self._like("Ifc Type", value) if contains else self._pattern("Ifc Type", value, " COLLATE NOCASE")
+
+        # There are only a few hundred types so match them here and look the rows up by exact type
+        value = value.lower()
+        if contains:
+            types = [t for t in self.types if value in t.lower()]
+        else:
+            types = [t for t in self.types if fnmatchcase(t.lower(), value)]
+        if not types:
+            return "0"
+        return f"type_id IN ({', '.join(self._param(self.types[t]) for t in types)})"
+
+    def _name_condition(self, value, contains):
+        return self._contains("Name", value) if contains else self._pattern("Name", value, " COLLATE NOCASE")
+
+    def _guid_condition(self, value, contains):
+        return self._contains("GUID", value) if contains else self._pattern("GUID", value)
+
+    def _line_condition(self, value, contains):
+        return self._contains("STEP Line", value) # Only ever searched for text inside it
+
+    def _id_condition(self, value, contains):
+        start, dots, end = value.replace("#", "").partition("..")
+        try:
+            start = int(start) if start else None
+            end = int(end) if end else None
+        except ValueError:
+            return None
+        if not dots:
+            return f"id = {self._param(start)}" if start is not None else None
+
+        conditions = []
+        if start is not None:
+            conditions.append(f"id >= {self._param(start)}")
+        if end is not None:
+            conditions.append(f"id <= {self._param(end)}")
+        return self._join(conditions, "AND")
+
+    # A comparison needs a property to compare, so pset:Pset_X=foo is not a property term
+    def _pset_condition(self, value, contains):
+        names, operator, value = split_property(value)
+        if len(names) == 1: # Only the property set
+            return self._property_condition(names[0], None, None, None, contains) if operator is None else None
+        return self._property_condition(".".join(names[:-1]), names[-1], operator, value, contains)
+
+    def _prop_condition(self, value, contains):
+        names, operator, value = split_property(value)
+        name = ".".join(names)
+        if operator and not name:
+            return None
+        return self._property_condition(None, name, operator, value, contains)
+
+    # Entities with a property in the properties table. Any of pset, name and operator can be left out
+    def _property_condition(self, pset, name, operator, value, contains):
+        if not self.properties:
+            return "0"
+        conditions = []
+        if name:
+            conditions.append(self._pattern("property", name, " COLLATE NOCASE"))
+        if pset:
+            conditions.append(self._pattern("pset", pset, " COLLATE NOCASE"))
+        if operator and value:
+            conditions.append(self._value_condition(operator, value, contains))
+        where = self._join(conditions, "AND")
+        if not where:
+            return None
+        return f"id IN (SELECT entity_id FROM properties WHERE {where})"
+
+    def _value_condition(self, operator, value, contains):
+        if contains:
+            condition = self._like("value_text", value)
+            return f"({condition}) IS NOT TRUE" if operator == "!=" else condition
+        try:
+            number = float(value)
+        except ValueError:
+            number = None
+
+        if operator in ("=", "!="):
+            if number is not None: # Numbers written as text like IFCLABEL('300') are found too
+                condition = f"(value_num = {self._param(number)} OR value_text = {self._param(value)})"
+            else:
+                condition = self._pattern("value_text", value, " COLLATE NOCASE")
+            return f"({condition}) IS NOT TRUE" if operator == "!=" else condition
+        if number is not None:
+            return f"value_num {operator} {self._param(number)}"
+        return f"value_text {operator} {self._param(value)}"
+
+# Whether a term (field, contains, value) only matches rows the previous term matched too
+def implies(term, previous):
+    if term == previous:
+        return True
+    field, contains, value = term
+    previous_field, previous_contains, previous_value = previous
+    if field != previous_field or field in FilterQuery.EXACT_FIELDS:
+        return False
+    if previous_contains: # Longer text can only be found where the shorter text is
+        if field is None and len(previous_value) < MIN_MATCH_LENGTH <= len(value):
+            return False # Unless the shorter text was not looked for in the STEP line (see SHORT_TEXT_COLUMNS)
+        return contains and previous_value in value
+    # Only a plain prefix like B-1* is sure to match everything a longer prefix does
+    prefix = literal_prefix(previous_value)
+    return not contains and previous_value == prefix + "*" and literal_prefix(value).startswith(prefix)
+
+# Returns (where, params) for the text of the filter bar
+def compile_filter(text, types=(), candidates=None, text_index=True, short_index=None, properties=True):
+    return FilterQuery(text, types, candidates, text_index, short_index, properties).compile()
@@ -0,0 +1,345 @@
+from PySide6.QtCore import Qt, QAbstractItemModel, QModelIndex, QCoreApplication, Slot
+from db import REFERENCE_PAGE_SIZE
+from strings import LOAD_MORE_REFERENCES_KEY, WAITING_FOR_REFERENCES_KEY, COUNTING_REFERENCES_KEY, READING_REFERENCES_KEY, ATTRIBUTE_LIST_KEY, LOAD_MORE_ITEMS_KEY
+
+# Kinds of rows in a ReferenceTreeModel
+ENTITY = 0 # An entity, expandable into the entities it references or is referenced by
+TEXT = 1   # An attribute of an entity that references nothing
+MORE = 2   # The last row of a page, loading the next page when clicked
+LOADING = 3 # The last row of an entity while a worker reads its references or until they can be read
+LIST = 4    # A list attribute of an entity that references nothing, expandable into its elements a page at a time
+ELEMENT = 5 # An element of a LIST, parsed when it is drawn
+ROW_FLAGS = Qt.ItemIsEnabled | Qt.ItemIsSelectable # Not editable. Asked for every row whenever the tree is laid out so made once
+
+class ReferenceNode:
+    __slots__ = ("parent", "row", "kind", "value", "children", "fetched", "total", "label")
+
+    # value: The STEP ID of an ENTITY, the text of a TEXT row, the attribute of a LIST or the byte span of an ELEMENT
+    def __init__(self, parent, row, kind, value):
+        self.parent = parent
+        self.row = row
+        self.kind = kind
+        self.value = value
+        self.children = []
+        self.fetched = False # Whether the first page of children has been read
+        self.total = 0       # Number of children including those not read yet. None until a worker has counted them
+        self.label = None    # Text shown for the row, made when it is first drawn
+
+    def loaded(self):
+        return len(self.children) - (1 if self.children and self.children[-1].kind in (MORE, LOADING) else 0)
+
+def is_below(node, ancestor):
+    while node is not None:
+        if node is ancestor:
+            return True
+        node = node.parent
+    return False
+
+# The ReferenceTreeModel class backs the reference trees on either side of the middle view.
+# Only the STEP IDs of the rows are kept. Labels are made when a row is first drawn.
+# Expanding an entity reads the first page of its children and the last row loads the next page,
+# so an entity referenced by hundreds of thousands of others only ever shows what was asked for.
+# Collapsing an entity drops its children so memory only holds what is expanded right now.
+# Where the children come from is up to the view:
+#   references(step_id, after, limit): The STEP IDs of up to limit children after the STEP ID after, in ascending order
+#   count(step_id): The number of children, only asked for when a full page was read
+#   label(step_id, expanded): The text of an entity row
+#   attributes(step_id): Rows shown instead when an entity has no children. Optional
+#     Either text or list attributes with a name, len(), spans(after, limit) and value(span) like AggregateAttribute
+#   prefetch(step_ids): Called with every page or chunk of entities before they are drawn so their labels can be read at once. Optional
+#   worker(step_id, after, limit, count): A QThread reading a page in the background, None to read it right away. Optional
+#     It emits counted(int) first when count is set, then chunk_ready(step_ids) for each part of the page in order.
+#     A page is streamed in below a row showing how far along it is, and dropped with cancel() when its entity goes away
+#   ready(): Whether the children can be read yet. Optional
+#     Until then an expanded entity only shows a row saying so, and is read once resume() is called
+class ReferenceTreeModel(QAbstractItemModel):
+    def __init__(self, header, references, count, label, attributes=None, prefetch=None, worker=None, ready=None,
+                 page_size=REFERENCE_PAGE_SIZE, parent=None):
+        super().__init__(parent)
+        self.header = header
+        self.references = references
+        self.count = count
+        self.label = label
+        self.attributes = attributes
+        self.prefetch = prefetch
+        self.worker = worker
+        self.ready = ready
+        self.page_size = max(1, page_size)
+        self._root = ReferenceNode(None, 0, ENTITY, None) # Invisible. Its only child is the entity being shown
+        self._root.fetched = True
+        self._workers = {} # Running worker: (entity, STEP IDs read so far). The entity is None once cancelled
+        self._waiting = [] # Expanded entities waiting for ready()
+
+    # Show step_id as the only top level row
+    def set_root(self, step_id):
+        self._cancel_workers()
+        self.beginResetModel()
+        self._root.children = [ReferenceNode(self._root, 0, ENTITY, step_id)]
+        self.endResetModel()
+
+    def clear(self):
+        self._cancel_workers()
+        self.beginResetModel()
+        self._root.children = []
+        self.endResetModel()
+
+    # Read the children of the entities expanded before ready() was true
+    @Slot()
+    def resume(self):
+        waiting, self._waiting = self._waiting, []
+        for node in waiting:
+            index = self._index(node)
+            self.beginRemoveRows(index, 0, 0)
+            node.children = []
+            self.endRemoveRows()
+            node.fetched = False
+            self._read_page(node, index)
+
+    # The STEP ID of an entity row, None for any other row
+    def step_id(self, index):
+        node = self._node(index)
+        return node.value if node is not self._root and node.kind == ENTITY else None
+
+    # Read the next page of children when the last row of a page is clicked
+    @Slot(QModelIndex)
+    def load_more(self, index):
+        node = self._node(index)
+        if node is self._root or node.kind != MORE:
+            return
+        parent = node.parent
+        parent_index = self.parent(index)
+        self.beginRemoveRows(parent_index, node.row, node.row)
+        parent.children.pop()
+        self.endRemoveRows()
+        self._read_page(parent, parent_index)
+
+    # Drop the children of a collapsed entity. They are read again when it is expanded
+    @Slot(QModelIndex)
+    def release(self, index):
+        node = self._node(index)
+        if node is self._root or not node.fetched:
+            return
+        self._cancel_workers(node)
+        if node.children:
+            self.beginRemoveRows(index, 0, len(node.children) - 1)
+            node.children = []
+            self.endRemoveRows()
+        node.fetched = False
+        node.label = None
+        self.dataChanged.emit(index, index)
+
+    def _node(self, index):
+        return index.internalPointer() if index.isValid() else self._root
+
+    def _index(self, node):
+        return self.createIndex(node.row, 0, node)
+
+    def _read_page(self, node, index):
+        if node.kind == LIST:
+            self._read_elements(node, index)
+            return
+        after = node.children[-1].value if node.children else 0
+        first = not node.fetched
+        node.fetched = True
+        if self.ready and not self.ready():
+            self._wait(node, index)
+            return
+        worker = self.worker(node.value, after, self.page_size, first) if self.worker else None
+        if worker is not None:
+            self._start_worker(node, index, worker, first)
+            return
+
+        step_ids = self.references(node.value, after, self.page_size)
+        if first:
+            node.total = self.count(node.value) if len(step_ids) == self.page_size else len(step_ids)
+        self._insert_children(node, index, step_ids)
+        self._end_page(node, index, len(step_ids))
+
+    def _insert_children(self, node, index, step_ids):
+        if not step_ids:
+            return
+        if self.prefetch:
+            self.prefetch(step_ids)
+        start = node.loaded()
+        self.beginInsertRows(index, start, start + len(step_ids) - 1)
+        node.children[start:start] = [ReferenceNode(node, start + i, ENTITY, step_id) for i, step_id in enumerate(step_ids)]
+        for row, child in enumerate(node.children[start + len(step_ids):], start + len(step_ids)):
+            child.row = row # The LOADING row stays last
+        self.endInsertRows()
+
+    # Only the spans of the elements are read here. Their values are parsed by data()
+    def _read_elements(self, node, index):
+        after = node.children[-1].value[1] if node.children else None
+        spans = node.value.spans(after, self.page_size)
+        node.fetched = True
+        node.total = len(node.value)
+        if spans:
+            start = len(node.children)
+            self.beginInsertRows(index, start, start + len(spans) - 1)
+            node.children.extend(ReferenceNode(node, start + i, ELEMENT, span) for i, span in enumerate(spans))
+            self.endInsertRows()
+        self._end_page(node, index, len(spans))
+
+    # Add the row loading the next page after a full page, or the attributes of an entity without references
+    def _end_page(self, node, index, read):
+        start = len(node.children)
+        if start == 0 and self.attributes and node.kind == ENTITY:
+            new_children = [ReferenceNode(node, i, TEXT if isinstance(row, str) else LIST, row)
+                            for i, row in enumerate(self.attributes(node.value))]
+        elif read == self.page_size and (node.total is None or start < node.total):
+            new_children = [ReferenceNode(node, start, MORE, None)]
+        else:
+            return
+        if new_children:
+            self.beginInsertRows(index, start, start + len(new_children) - 1)
+            node.children.extend(new_children)
+            self.endInsertRows()
+
+    def _wait(self, node, index):
+        node.total = None
+        self.beginInsertRows(index, 0, 0)
+        node.children = [ReferenceNode(node, 0, LOADING, None)]
+        self.endInsertRows()
+        self._waiting.append(node)
+
+    def _start_worker(self, node, index, worker, first):
+        if first:
+            node.total = None
+        start = len(node.children)
+        self.beginInsertRows(index, start, start)
+        node.children.append(ReferenceNode(node, start, LOADING, None))
+        self.endInsertRows()
+
+        self._workers[worker] = (node, 0)
+        worker.counted.connect(self._counted)
+        worker.chunk_ready.connect(self._chunk_ready)
+        worker.finished.connect(self._worker_finished)
+        worker.start()
+
+    # Stop the workers reading the references of node and of the entities below it, or every worker
+    def _cancel_workers(self, node=None):
+        self._waiting = [entity for entity in self._waiting if node is not None and not is_below(entity, node)]
+        for worker, (entity, read) in list(self._workers.items()):
+            if entity is not None and (node is None or is_below(entity, node)):
+                worker.cancel()
+                self._workers[worker] = (None, read) # Kept until its thread ends
+
+    @Slot(int)
+    def _counted(self, total):
+        node, read = self._workers.get(self.sender(), (None, 0))
+        if node is None:
+            return
+        node.total = total
+        self._update_loading_row(node)
+
+    @Slot(object)
+    def _chunk_ready(self, step_ids):
+        worker = self.sender()
+        node, read = self._workers.get(worker, (None, 0))
+        if node is None:
+            return
+        self._workers[worker] = (node, read + len(step_ids))
+        self._insert_children(node, self._index(node), step_ids)
+        self._update_loading_row(node)
+
+    @Slot()
+    def _worker_finished(self):
+        node, read = self._workers.pop(self.sender(), (None, 0))
+        if node is None:
+            return
+        index = self._index(node)
+        loading = node.children[-1]
+        self.beginRemoveRows(index, loading.row, loading.row)
+        node.children.pop()
+        self.endRemoveRows()
+        if node.total is None: # The count failed
+            node.total = node.loaded()
+        self._end_page(node, index, read)
+
+    def _update_loading_row(self, node):
+        loading = node.children[-1]
+        loading.label = None
+        loading_index = self._index(loading)
+        self.dataChanged.emit(loading_index, loading_index)
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self._node(parent)
+        if column != 0 or not 0 <= row < len(node.children):
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is None or parent is self._root:
+            return QModelIndex()
+        return self.createIndex(parent.row, 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self._node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    # Entities show an arrow until they turn out to have no children
+    def hasChildren(self, parent=QModelIndex()):
+        node = self._node(parent)
+        if node is self._root:
+            return bool(node.children)
+        return node.kind in (ENTITY, LIST) and (not node.fetched or bool(node.children))
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        return node is not self._root and node.kind in (ENTITY, LIST) and not node.fetched
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        if node is self._root or node.fetched:
+            return
+        self._read_page(node, parent)
+        node.label = None # The label of an expanded entity can say more about it
+        self.dataChanged.emit(parent, parent)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        node = index.internalPointer()
+        if node.label is None:
+            if node.kind == ENTITY:
+                node.label = self.label(node.value, node.fetched)
+            elif node.kind == TEXT:
+                node.label = node.value
+            elif node.kind == LIST:
+                # "{name}: {count} items"
+                node.label = QCoreApplication.translate("Reference Tree", ATTRIBUTE_LIST_KEY).format(
+                    name=node.value.name, count=len(node.value))
+            elif node.kind == ELEMENT:
+                node.label = f"[{node.row}] {node.parent.value.value(node.value)}"
+            elif node.kind == LOADING:
+                parent = node.parent
+                if parent in self._waiting:
+                    node.label = QCoreApplication.translate("Reference Tree", WAITING_FOR_REFERENCES_KEY)
+                elif parent.total is None:
+                    node.label = QCoreApplication.translate("Reference Tree", COUNTING_REFERENCES_KEY)
+                else:
+                    # "Reading {loaded} of {total} references..."
+                    node.label = QCoreApplication.translate("Reference Tree", READING_REFERENCES_KEY).format(
+                        loaded=parent.loaded(), total=parent.total)
+            else:
+                remaining = node.parent.total - node.parent.loaded()
+                # "Load the next {count} of {remaining} references" or "... items" for a list attribute
+                key = LOAD_MORE_ITEMS_KEY if node.parent.kind == LIST else LOAD_MORE_REFERENCES_KEY
+                node.label = QCoreApplication.translate("Reference Tree", key).format(
+                    count=min(self.page_size, remaining), remaining=remaining)
+        return node.label
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.header
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return ROW_FLAGS
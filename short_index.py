@@ -0,0 +1,58 @@
+import bisect
+import itertools
+import operator
+import time
+from array import array
+
+SHORT_TERM_LENGTH = 2 # Longest term looked up in a ShortTermIndex. Longer ones go to the trigram filter index
+READ_CHUNK_SIZE = 65536 # Rows read from the database at a time
+SEARCH_CHUNK_SIZE = 16384 # Rows tested before the GIL is let go. About 2ms each so the GUI thread can draw in between
+
+# The text of a row kept by a ShortTermIndex. The separator keeps a term from spanning the Name and the GUID
+def fold(name, guid):
+    return f"{name or ''}\0{guid or ''}".casefold()
+
+# The ShortTermIndex class finds the rows whose Name or GUID contain a term of one or two characters,
+# which the trigram filter index cannot find.
+# The case folded Name and GUID of every row are kept as one string each, in STEP ID order,
+# and a search tests them without leaving C (compress over operator.contains), SEARCH_CHUNK_SIZE rows at a time.
+# That takes about 100ms per million rows no matter how many of them match, about half as long as LIKE,
+# and the rows take about 70 bytes each. bytes are 4 times slower to search than str.
+# A search runs on the thread of the query that asks for it, but C holds the GIL the whole time,
+# so it is let go after every chunk. Otherwise the GUI would freeze until the search is done.
+# Unigram and bigram posting lists answer in no time but took 200MB and 26 seconds to build for a million rows.
+class ShortTermIndex:
+    def __init__(self):
+        self.ids = array("q")
+        self._texts = []
+
+    # rows: (id, Name, GUID) in STEP ID order
+    # Returns None if should_stop returns True before every row is read
+    def build(self, rows, should_stop=None):
+        while chunk := list(itertools.islice(rows, READ_CHUNK_SIZE)):
+            if should_stop and should_stop():
+                return None
+            self.ids.extend([row[0] for row in chunk])
+            self._texts.extend([fold(name, guid) for _, name, guid in chunk])
+        return self
+
+    # The STEP IDs of the rows containing term, in ascending order
+    # step_ids: Only the rows to test, like those of an earlier result being narrowed down
+    def search(self, term, step_ids=None):
+        term = term.casefold()
+        if step_ids is not None:
+            return array("q", (step_id for step_id in sorted(step_ids) if term in self._text(step_id)))
+        step_ids = array("q")
+        for start in range(0, len(self.ids), SEARCH_CHUNK_SIZE):
+            end = start + SEARCH_CHUNK_SIZE
+            matches = map(operator.contains, self._texts[start:end], itertools.repeat(term))
+            step_ids.extend(itertools.compress(self.ids[start:end], matches))
+            time.sleep(0) # Let go of the GIL
+        return step_ids
+
+    def _text(self, step_id):
+        i = bisect.bisect_left(self.ids, step_id)
+        return self._texts[i] if i < len(self.ids) and self.ids[i] == step_id else ""
+
+    def __len__(self):
+        return len(self.ids)
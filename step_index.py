@@ -0,0 +1,129 @@
+import mmap
+import re
+import operator
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+ENTITY_START = re.compile(rb"^[ \t]*#(\d+)[ \t]*=", re.MULTILINE) # "#123=" at the start of a line
+SCAN_CHUNK_SIZE = 64 * 1024 * 1024 # Bytes scanned between progress updates
+
+# The StepIndex class maps STEP IDs to the location of their instances in the .ifc file.
+# One pass over the file records where every "#id=" starts. The IDs, offsets and lengths are kept in
+# typed arrays (20 bytes per entity) rather than a dict and the file is memory-mapped so the
+# original bytes of any instance can be served without asking ifcopenshell to serialize it again.
+# An instance ends where the next one starts and instances are assumed to start on a new line,
+# which is true for every exporter we have seen.
+class StepIndex:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.data_start = 0
+        self.ids = array("q")
+        self.offsets = array("q")
+        self.lengths = array("i") # Includes the line break after the instance
+
+    # Scan the DATA section of the file
+    # progress_callback receives the percentage of bytes scanned
+    # Returns None if should_stop returns True before the scan is finished
+    def build(self, progress_callback=None, should_stop=None):
+        data_start = self._map.find(b"\nDATA;")
+        data_start = 0 if data_start == -1 else data_start
+        self.data_start = data_start
+        data_end = self._map.find(b"\nENDSEC;", data_start)
+        data_end = len(self._map) if data_end == -1 else data_end
+
+        ids = self.ids
+        offsets = self.offsets
+        position = data_start
+        while position < data_end:
+            if should_stop and should_stop():
+                self.close()
+                return None
+
+            # Always end a chunk on a line break so no "#id=" is split between two chunks
+            chunk_end = self._map.find(b"\n", min(position + SCAN_CHUNK_SIZE, data_end))
+            chunk_end = data_end if chunk_end == -1 or chunk_end > data_end else chunk_end + 1
+
+            for match in ENTITY_START.finditer(self._map, position, chunk_end):
+                ids.append(int(match.group(1)))
+                offsets.append(match.start(1) - 1) # Start at the "#"
+            position = chunk_end
+
+            if progress_callback:
+                progress_callback(int(position / len(self._map) * 100))
+
+        ends = islice(offsets, 1, None)
+        self.lengths = array("i", map(operator.sub, ends, offsets))
+        self.lengths.append(data_end - offsets[-1] if offsets else 0)
+
+        if not all(map(operator.lt, ids, islice(ids, 1, None))):
+            self._sort()
+
+        return self
+
+    # Sort by STEP ID for files that were not written in order
+    def _sort(self):
+        order = sorted(range(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array("q", (self.ids[i] for i in order))
+        self.offsets = array("q", (self.offsets[i] for i in order))
+        self.lengths = array("i", (self.lengths[i] for i in order))
+
+    # The HEADER section of the file
+    def header(self):
+        return self._map[:self.data_start or 4096]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, step_id):
+        return self._position(step_id) is not None
+
+    def _position(self, step_id):
+        i = bisect_left(self.ids, step_id)
+        if i < len(self.ids) and self.ids[i] == step_id:
+            return i
+        return None
+
+    # Location of an instance in the file as (offset, length)
+    def span(self, step_id):
+        i = self._position(step_id)
+        if i is None:
+            return None
+        return self.offsets[i], self.lengths[i]
+
+    # The original bytes of an instance from "#" up to and including the closing ";"
+    def raw(self, step_id, max_bytes=None):
+        span = self.span(step_id)
+        if span is None:
+            return None
+
+        offset, length = span
+        if max_bytes is not None and length > max_bytes:
+            return self._map[offset:offset + max_bytes]
+
+        text = self._map[offset:offset + length]
+        end = text.rfind(b";") # Drop the line break and anything else between the instance and the next one
+        return text[:end + 1] if end != -1 else text.rstrip()
+
+    # The original step line of an instance as text
+    def line(self, step_id):
+        text = self.raw(step_id)
+        return None if text is None else text.decode("utf-8", errors="replace")
+
+    # The start of the step line for labels. Reads at most max_chars bytes no matter how long the instance is
+    def line_prefix(self, step_id, max_chars=200):
+        text = self.raw(step_id, max_bytes=max_chars + 1)
+        if text is None:
+            return None
+        text = text.decode("utf-8", errors="replace")
+        return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+    def close(self):
+        try:
+            self._map.close()
+            self._file.close()
+        except (BufferError, ValueError) as e:
+            print(f"Unable to close step index\n{e}")
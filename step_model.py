@@ -0,0 +1,385 @@
+import re
+import ifcopenshell
+import ifcopenshell.ifcopenshell_wrapper
+
+# Tokens of a STEP instance. Commas and whitespace are skipped
+TOKENS = re.compile(r"""
+     (?P<string>'(?:[^']|'')*')
+    |(?P<ref>\#\d+)
+    |(?P<enum>\.[A-Za-z0-9_]+\.)
+    |(?P<binary>"[0-9A-Fa-f]*")
+    |(?P<keyword>[A-Za-z][A-Za-z0-9_]*)
+    |(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?P<null>[$*])
+""", re.VERBOSE)
+
+INSTANCE_HEAD = re.compile(r"\s*#(\d+)\s*=\s*([A-Za-z0-9_]+)\s*") # "#123=IFCWALL"
+REFERENCE_TOKENS = re.compile(rb"#(\d+)|([(),])") # A reference or anything that moves to the next attribute
+STRING = re.compile(rb"'(?:[^']|'')*'")
+FILE_SCHEMA = re.compile(rb"FILE_SCHEMA\s*\(\s*\(\s*'([^']+)'")
+LIST_DEPTH = 6 # Deepest nesting of lists inside an attribute value matched by VALUE
+
+# A list with up to depth lists nested inside it. Possessive so a cut off list fails right away instead of backtracking
+def nested_list_pattern(depth):
+    inner = rb"[^()']++|'(?:[^']|'')*+'"
+    if depth:
+        inner += rb"|" + nested_list_pattern(depth - 1)
+    return rb"\((?>" + inner + rb")*+\)"
+
+# One value of a list or attribute list. A list is matched by the regex engine in one go
+# so a list of hundreds of thousands of coordinates is skipped without a Python loop over its elements
+VALUE = re.compile(rb"\s*((?:[A-Za-z0-9_]*\s*" + nested_list_pattern(LIST_DEPTH) + rb"|'(?:[^']|'')*+'|[^,()']*))\s*")
+NEXT_VALUE = re.compile(rb"\s*,")
+INNER_LIST = re.compile(rb"\([^()]*\)")
+NOT_STRUCTURE = bytes(sorted(set(range(256)) - set(b"(),"))) # Deleted from a list before counting its values
+
+# Control directives used to encode characters in STEP strings
+STRING_ESCAPES = re.compile(r"""
+     \\X2\\((?:[0-9A-Fa-f]{4})*)\\X0\\
+    |\\X4\\((?:[0-9A-Fa-f]{8})*)\\X0\\
+    |\\X\\([0-9A-Fa-f]{2})
+    |\\S\\(.)
+    |\\P[A-Za-z]\\
+    |\\\\
+""", re.VERBOSE)
+
+def decode_step_string(token):
+    text = token[1:-1].replace("''", "'")
+
+    def replacer(match):
+        x2, x4, x, s = match.groups()
+        if x2 is not None:
+            return bytes.fromhex(x2).decode("utf-16-be", errors="replace")
+        if x4 is not None:
+            return bytes.fromhex(x4).decode("utf-32-be", errors="replace")
+        if x is not None:
+            return chr(int(x, 16))
+        if s is not None:
+            return chr(ord(s) + 128)
+        if match.group().startswith("\\P"): # Code page switches are not needed for decoding
+            return ""
+        return "\\"
+
+    return STRING_ESCAPES.sub(replacer, text) if "\\" in text else text
+
+# A reference to another instance inside a parsed attribute list
+class Reference(int):
+    pass
+
+# A value wrapped in a defined type like IFCLABEL('B-12')
+class TypedValue:
+    __slots__ = ("type_name", "wrappedValue")
+
+    def __init__(self, type_name, value):
+        self.type_name = type_name
+        self.wrappedValue = value
+
+    def is_a(self, type_name=None):
+        if type_name is None:
+            return self.type_name
+        return self.type_name.lower() == type_name.lower()
+
+    def __repr__(self):
+        return f"{self.type_name}({self.wrappedValue!r})"
+
+class _Keyword(str):
+    pass
+
+def convert_token(kind, value):
+    if kind == "string":
+        return decode_step_string(value)
+    if kind == "ref":
+        return Reference(value[1:])
+    if kind == "number":
+        return float(value) if any(c in value for c in ".eE") else int(value)
+    if kind == "enum":
+        value = value[1:-1]
+        return {"T": True, "F": False, "U": "UNKNOWN"}.get(value, value)
+    if kind == "binary":
+        return value[1:-1]
+    return None # $ and *
+
+# Parse the attributes of an instance like "#1=IFCWALL('guid',#2,...);"
+# Returns (step_id, TYPE, attributes). Stops after limit attributes when given
+# so reading the first few attributes of an instance with a huge list stays cheap
+def parse_instance(text, limit=None):
+    head = INSTANCE_HEAD.match(text)
+    if not head:
+        return None
+
+    stack = []
+    for match in TOKENS.finditer(text, head.end()):
+        kind = match.lastgroup
+        if kind == "open":
+            stack.append([])
+            continue
+
+        if kind == "close":
+            items = stack.pop()
+            if not stack:
+                break
+            parent = stack[-1]
+            if parent and isinstance(parent[-1], _Keyword):
+                parent[-1] = TypedValue(str(parent[-1]), items[0] if items else None)
+            else:
+                parent.append(tuple(items))
+        elif kind == "keyword":
+            stack[-1].append(_Keyword(match.group()))
+        else:
+            stack[-1].append(convert_token(kind, match.group()))
+
+        # A keyword is only the start of a typed value like IFCLABEL('B-12') so read on until its value is closed
+        if limit is not None and len(stack) == 1 and len(stack[0]) >= limit and not isinstance(stack[0][-1], _Keyword):
+            items = stack[0]
+            break
+    else: # The instance is cut off
+        items = stack[0] if stack else []
+
+    return int(head.group(1)), head.group(2), items[:limit] if limit is not None else items
+
+# The byte spans of the values of the list opened at raw[start], up to limit of them
+# after: The end of the last span of the previous page. Reading starts at the value following it
+def list_values(raw, start, after=None, limit=None):
+    pos = start + 1
+    if after is not None:
+        separator = NEXT_VALUE.match(raw, after)
+        if not separator:
+            return []
+        pos = separator.end()
+
+    spans = []
+    while limit is None or len(spans) < limit:
+        match = VALUE.match(raw, pos)
+        value_start, value_end = match.span(1)
+        end = raw[match.end():match.end() + 1]
+        if end not in (b",", b")"): # Cut off or nested deeper than LIST_DEPTH
+            break
+        if value_start == value_end and end == b")" and after is None and not spans: # ()
+            break
+        spans.append((value_start, value_end))
+        if end == b")":
+            break
+        pos = match.end() + 1
+    return spans
+
+# The byte spans of the attributes of an instance
+def attribute_spans(raw):
+    start = raw.find(b"(", raw.find(b"="))
+    return list_values(raw, start) if start != -1 else []
+
+# Number of values in the list spanning raw[start:end] without finding where each one is.
+# Only the brackets and commas are kept, the lists inside it are dropped innermost first and the commas left are counted
+def count_values(raw, start, end):
+    body = raw[start + 1:end - 1]
+    if not body.strip():
+        return 0
+    if b"'" in body:
+        body = STRING.sub(b"''", body)
+    body = body.translate(None, NOT_STRUCTURE)
+    while True:
+        flattened = INNER_LIST.sub(b"", body)
+        if len(flattened) == len(body):
+            break
+        body = flattened
+    return body.count(b",") + 1
+
+# Parse a single value like b"(0.,1.,2.)" or b"IFCLABEL('B-12')"
+def parse_value(raw):
+    attributes = parse_instance(f"#0=VALUE({raw.decode('utf-8', errors='replace')});")[2]
+    return attributes[0] if attributes else None
+
+# The AggregateAttribute class is a list attribute shown a page at a time under an entity of the right view.
+# Its length is counted up front but only the spans of the pages read so far are kept
+# and an element is only parsed from the step line when it is drawn.
+class AggregateAttribute:
+    __slots__ = ("name", "raw", "start", "end", "length")
+
+    # raw: The step line, shared by the attributes of an instance. span: The bytes of the list in it
+    def __init__(self, name, raw, span):
+        self.name = name
+        self.raw = raw
+        self.start, self.end = span
+        self.length = count_values(raw, self.start, self.end)
+
+    def __len__(self):
+        return self.length
+
+    def spans(self, after=None, limit=None):
+        return list_values(self.raw, self.start, after, limit)
+
+    def value(self, span):
+        return parse_value(self.raw[span[0]:span[1]])
+
+# The (ID, attribute index) of every reference an instance makes, ignoring anything that looks like a reference inside a string
+# Only the commas outside of lists move on to the next attribute
+def references(raw):
+    body = raw[raw.find(b"=") + 1:]
+    if b"'" in body:
+        body = STRING.sub(b"''", body)
+    refs = []
+    depth = index = 0
+    for ref, punctuation in REFERENCE_TOKENS.findall(body):
+        if ref:
+            refs.append((int(ref), index))
+        elif punctuation == b",":
+            if depth == 1:
+                index += 1
+        elif punctuation == b"(":
+            depth += 1
+        else:
+            depth -= 1
+    return refs
+
+# The StepModel class stands in for ifcopenshell.file when a file is only browsed.
+# It never loads the model into ifcopenshell. Entities are materialized as RawEntity objects
+# from the original step lines served by a StepIndex only when a view asks for them.
+# Inverse references are looked up in the refs table DBWorker builds from the same step lines,
+# so get_inverse returns None until the database is attached and its refs table is indexed.
+class StepModel:
+    def __init__(self, step_index):
+        self.step_index = step_index
+        self.db = None # Connection to the database built by DBWorker
+        self.references_indexed = False # Whether the refs table of db is complete and indexed
+
+        schema = FILE_SCHEMA.search(step_index.header())
+        self.schema = schema.group(1).decode() if schema else "IFC4"
+        try:
+            self._schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(self.schema)
+        except Exception as e:
+            print(f"Unknown schema {self.schema}\n{e}")
+            self._schema = None
+
+        self._declarations = {} # TYPE -> (IfcType, attribute names, supertype names)
+
+    def attach_db(self, db):
+        self.db = db
+        self.references_indexed = False
+
+    # The CamelCase name, attribute names and the names of every supertype of an upper case STEP type
+    def declaration(self, step_type):
+        declaration = self._declarations.get(step_type)
+        if declaration:
+            return declaration
+
+        try:
+            entity = self._schema.declaration_by_name(step_type)
+            names = []
+            supertypes = {entity.name().lower()}
+            if hasattr(entity, "all_attributes"): # Defined types like IFCLABEL only have a name
+                names = [attribute.name() for attribute in entity.all_attributes()]
+                parent = entity.supertype()
+                while parent:
+                    supertypes.add(parent.name().lower())
+                    parent = parent.supertype()
+            declaration = (entity.name(), names, supertypes)
+        except Exception: # Unknown to the schema so keep the name from the file
+            declaration = (step_type, [], {step_type.lower()})
+
+        self._declarations[step_type] = declaration
+        return declaration
+
+    # Parse an instance into (IfcType, attributes)
+    def parse(self, step_id, limit=None):
+        raw = self.step_index.raw(step_id)
+        if raw is None:
+            raise RuntimeError(f"Instance #{step_id} not found")
+        _, step_type, attributes = parse_instance(raw.decode("utf-8", errors="replace"), limit)
+        return self.declaration(step_type.upper())[0], attributes
+
+    def type_of(self, step_id):
+        head = INSTANCE_HEAD.match(self.step_index.line_prefix(step_id, 100) or "")
+        if not head:
+            raise RuntimeError(f"Instance #{step_id} not found")
+        return self.declaration(head.group(2).upper())[0]
+
+    def by_id(self, step_id):
+        if step_id not in self.step_index:
+            raise RuntimeError(f"Instance #{step_id} not found")
+        return RawEntity(self, step_id)
+
+    # Rows are still being inserted into refs until DBWorker indexes it. Reading it then would scan the table
+    # and miss the rows to come, so None is returned to say the references are not known yet
+    def get_inverse(self, entity):
+        if self.db is None:
+            return None
+        if not self.references_indexed:
+            self.references_indexed = self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'refs_dst'").fetchone() is not None
+            if not self.references_indexed:
+                return None
+        rows = self.db.execute("SELECT DISTINCT src FROM refs WHERE dst = ? ORDER BY src", (entity.id(),))
+        return [RawEntity(self, row[0]) for row in rows]
+
+    def wrap(self, value):
+        if isinstance(value, Reference):
+            return RawEntity(self, int(value))
+        if isinstance(value, tuple):
+            return tuple(self.wrap(v) for v in value)
+        if isinstance(value, TypedValue):
+            value.type_name = self.declaration(value.type_name.upper())[0]
+        return value
+
+    def __iter__(self):
+        for step_id in self.step_index.ids:
+            yield RawEntity(self, step_id)
+
+    def __len__(self):
+        return len(self.step_index)
+
+# The RawEntity class stands in for ifcopenshell.entity_instance in a StepModel.
+# Nothing but the STEP ID is kept. Attributes are parsed from the original step line on every access.
+class RawEntity:
+    __slots__ = ("model", "_id")
+
+    def __init__(self, model, step_id):
+        self.model = model
+        self._id = step_id
+
+    def id(self):
+        return self._id
+
+    def is_a(self, type_name=None):
+        ifc_type = self.model.type_of(self._id)
+        if type_name is None:
+            return ifc_type
+        return type_name.lower() in self.model.declaration(ifc_type.upper())[2]
+
+    def attribute_names(self):
+        return self.model.declaration(self.model.type_of(self._id).upper())[1]
+
+    def get_info(self):
+        ifc_type, attributes = self.model.parse(self._id)
+        names = self.model.declaration(ifc_type.upper())[1] or [f"Attribute {i}" for i in range(len(attributes))]
+        info = {"id": self._id, "type": ifc_type}
+        info.update((name, self.model.wrap(value)) for name, value in zip(names, attributes))
+        return info
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        names = self.attribute_names()
+        if name not in names:
+            raise AttributeError(f"{self.is_a()} has no attribute {name}")
+        index = names.index(name)
+        _, attributes = self.model.parse(self._id, limit=index + 1)
+        return self.model.wrap(attributes[index]) if index < len(attributes) else None
+
+    def __iter__(self):
+        _, attributes = self.model.parse(self._id)
+        return (self.model.wrap(value) for value in attributes)
+
+    def __str__(self):
+        return self.model.step_index.line(self._id)
+
+    def __repr__(self):
+        return str(self)
+
+    def __eq__(self, other):
+        return isinstance(other, RawEntity) and other._id == self._id and other.model is self.model
+
+    def __hash__(self):
+        return hash(self._id)
+
+ENTITY_TYPES = (ifcopenshell.entity_instance, RawEntity) # Anything the views can show as an entity
@@ -7,6 +7,7 @@ from PySide6.QtCore import QCoreApplication as q
 MAIN_TOOLBAR_ACTION_KEYS = [
     "Open File",
     "Load Entities",
+    "Cancel",
     "Assembly Exporter",
     "Phase Exporter",
     "Options"
@@ -14,6 +15,7 @@ MAIN_TOOLBAR_ACTION_KEYS = [
 MAIN_TOOLBAR_TOOLTIP_KEYS = [
     "Load a new IFC file",
     "Display the IFC file contents",
+    "Stop loading the current file",
     "Export assemblies to a new IFC file",
     "Export phases to a new IFC file",
     "Open the options window"
@@ -25,6 +27,7 @@ def mark_toolbar_translations():
     # Toolbar actions
     q.translate("Main Toolbar", "Open File")
     q.translate("Main Toolbar", "Load Entities")
+    q.translate("Main Toolbar", "Cancel")
     q.translate("Main Toolbar", "Assembly Exporter")
     q.translate("Main Toolbar", "Phase Exporter")
     q.translate("Main Toolbar", "Options")
@@ -32,6 +35,7 @@ def mark_toolbar_translations():
     # Toolbar Tooltips
     q.translate("Main Toolbar", "Load a new IFC file")
     q.translate("Main Toolbar", "Display the IFC file contents")
+    q.translate("Main Toolbar", "Stop loading the current file")
     q.translate("Main Toolbar", "Export assemblies to a new IFC file")
     q.translate("Main Toolbar", "Export phases to a new IFC file")
     q.translate("Main Toolbar", "Open the options window")
@@ -63,6 +67,7 @@ FILE_MENU_KEY = "File"
 
 FILE_MENU_ACTION_KEYS = [
     "Open",
+    "Browse (Low Memory)",
     "New Window",
     "Recent Files"
 ]
@@ -72,6 +77,7 @@ RECENT_FILES_MENU_KEY = "Recent Files"
 def mark_file_menu_translations():
     q.translate("Main File Menu", "File")
     q.translate("Main File Menu", "Open")
+    q.translate("Main File Menu", "Browse (Low Memory)")
     q.translate("Main File Menu", "New Window")
     q.translate("Main File Menu", "Recent Files")
 
@@ -85,7 +91,8 @@ MAIN_STATUS_LABEL_KEYS = [
     "Now loading IFC model into view",
     "Finished loading {file_path}",
     "Loaded {file_path}\nPress the \"Load Entities\" button to view the contents",
-    "Selected entity #{id}"
+    "Selected entity #{id}",
+    "Cancelled loading {file_path}"
 ]
 
 def mark_main_status_label_keys():
@@ -95,6 +102,7 @@ def mark_main_status_label_keys():
     q.translate("Main Status Label", "Finished loading {file_path}")
     q.translate("Main Status Label", "Loaded {file_path}\nPress the \"Load Entities\" button to view the contents")
     q.translate("Main Status Label", "Selected entity #{id}")
+    q.translate("Main Status Label", "Cancelled loading {file_path}")
 
 # ==============================
 # FILTER WIDGET
@@ -102,23 +110,83 @@ def mark_main_status_label_keys():
 
 FILTER_WIDGET_KEYS = [
     "Filter Entities...", # Filter input text box
-    "Filter"              # Filter apply button
+    "Filter",             # Filter apply button
+    # Filter input text box tooltip
+    "Text anywhere in a row or fields like type:IfcBeam name:B-1* guid:2O2Fr$* id:1000..2000 line:IFCCARTESIANPOINT\n"
+    "Properties with prop:Weight>500 or pset:Tekla*.AssemblyMark=B-12\n"
+    "field:~text finds text anywhere in the field. Combine terms with AND, OR, NOT and parentheses"
 ]
 
 def mark_filter_widget_keys():
     q.translate("Filter Widget", "Filter Entities...")
     q.translate("Filter Widget", "Filter")
+    q.translate("Filter Widget", "Text anywhere in a row or fields like type:IfcBeam name:B-1* guid:2O2Fr$* id:1000..2000 line:IFCCARTESIANPOINT\n"
+                "Properties with prop:Weight>500 or pset:Tekla*.AssemblyMark=B-12\n"
+                "field:~text finds text anywhere in the field. Combine terms with AND, OR, NOT and parentheses")
 
 # ==============================
 # ROW COUNT
 # ==============================
 
 ROW_COUNT_KEY      = "{items} rows"
-BUILDING_INDEX_KEY = "Building index for filtering. Please Wait..."
+FILTERING_KEY      = "Filtering..."
 
 def mark_row_count_key():
     q.translate("Row Count", "{items} rows")
-    q.translate("Row Count", "Building index for filtering. Please Wait...")
+    q.translate("Row Count", "Filtering...")
+
+# ==============================
+# LOAD STAGES
+# ==============================
+
+# Shown in the progress bar while a file is loaded
+# Order must match the stage numbers in db.py
+LOAD_STAGE_KEYS = [
+    "Opening file",
+    "Reading entities",
+    "Indexing references",
+    "Counting types",
+    "Indexing sort keys",
+    "Building filter index",
+    "Indexing properties"
+]
+
+def mark_load_stage_keys():
+    q.translate("Load Stages", "Opening file")
+    q.translate("Load Stages", "Reading entities")
+    q.translate("Load Stages", "Indexing references")
+    q.translate("Load Stages", "Counting types")
+    q.translate("Load Stages", "Indexing sort keys")
+    q.translate("Load Stages", "Building filter index")
+    q.translate("Load Stages", "Indexing properties")
+
+# ==============================
+# REFERENCE TREES
+# ==============================
+
+# Last row of an expanded entity with more references than have been read. Reads the next page when clicked
+LOAD_MORE_REFERENCES_KEY = "Load the next {count} of {remaining} references"
+
+def mark_load_more_references_key():
+    q.translate("Reference Tree", "Load the next {count} of {remaining} references")
+
+# Last row of an entity while its references are read in the background or until the database can be read
+WAITING_FOR_REFERENCES_KEY = "Waiting for the references to be indexed..."
+COUNTING_REFERENCES_KEY = "Counting references..."
+READING_REFERENCES_KEY = "Reading {loaded} of {total} references..."
+
+def mark_reading_references_keys():
+    q.translate("Reference Tree", "Waiting for the references to be indexed...")
+    q.translate("Reference Tree", "Counting references...")
+    q.translate("Reference Tree", "Reading {loaded} of {total} references...")
+
+# A list attribute of an entity in the right view. Expands into its elements a page at a time
+ATTRIBUTE_LIST_KEY = "{name}: {count} items"
+LOAD_MORE_ITEMS_KEY = "Load the next {count} of {remaining} items"
+
+def mark_attribute_list_keys():
+    q.translate("Reference Tree", "{name}: {count} items")
+    q.translate("Reference Tree", "Load the next {count} of {remaining} items")
 
 # ======================================
 # ASSEMBLY EXPORTER
@@ -180,11 +248,41 @@ STATS_PANEL_KEYS = [
     "IFC Version: {version}",
     "Entity Count: {count}",
     "Loaded in {time}s",
-    "Total Entity Types: {count}"
+    "Total Entity Types: {count}",
+    "{stage}: {time}s"
 ]
 
 def mark_stats_panel_keys():
     q.translate("Stats Panel", "IFC Version: {version}")
     q.translate("Stats Panel", "Entity Count: {count}")
     q.translate("Stats Panel", "Loaded in {time}s")
-    q.translate("Stats Panel", "Total Entity Types: {count}")
\ No newline at end of file
+    q.translate("Stats Panel", "Total Entity Types: {count}")
+    q.translate("Stats Panel", "{stage}: {time}s")
+
+# ==============================
+# OPTIONS DIALOG
+# ==============================
+
+OPTIONS_CACHE_KEYS = [
+    "Entity Cache: {size} MB",
+    "Limit (GB)",
+    "Clear Cache"
+]
+
+def mark_options_cache_keys():
+    q.translate("Options Dialog", "Entity Cache: {size} MB")
+    q.translate("Options Dialog", "Limit (GB)")
+    q.translate("Options Dialog", "Clear Cache")
+
+OPTIONS_INDEXING_KEYS = [
+    "Indexing Processes",
+    "Each process loads its own copy of the model",
+    "Index Properties",
+    "Lets the filter bar find property values with pset: and prop:. Files already in the entity cache keep their index"
+]
+
+def mark_options_indexing_keys():
+    q.translate("Options Dialog", "Indexing Processes")
+    q.translate("Options Dialog", "Each process loads its own copy of the model")
+    q.translate("Options Dialog", "Index Properties")
+    q.translate("Options Dialog", "Lets the filter bar find property values with pset: and prop:. Files already in the entity cache keep their index")
@@ -42,10 +42,18 @@ class ClickableLabel(QLabel):
         }
         """
 
+# 1536 -> "1.5 KB"
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
 class StatsPanel(QWidget):
     label_clicked = Signal(str)
 
-    def __init__(self, ifc_version=None, entity_dict=None, time_to_load=None):
+    def __init__(self, ifc_version=None, entity_dict=None, time_to_load=None, stage_times=None):
         super().__init__()
 
         # Layout setup
@@ -56,9 +64,11 @@ class StatsPanel(QWidget):
         self.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.MinimumExpanding)
         self.setMinimumWidth(200)
 
-        self.update_stats(ifc_version, entity_dict, time_to_load)
+        self.update_stats(ifc_version, entity_dict, time_to_load, stage_times)
 
-    def update_stats(self, ifc_version=None, entity_dict=None, time_to_load=None):
+    # entity_dict: {Ifc Type: (count, step line bytes)}
+    # stage_times: {translated stage name: seconds} for each stage of the load
+    def update_stats(self, ifc_version=None, entity_dict=None, time_to_load=None, stage_times=None):
         # Clear layout
         while self.layout.count():
             item = self.layout.takeAt(0)
@@ -78,15 +88,22 @@ class StatsPanel(QWidget):
                                      context="Stats Panel",
                                      format_args={"time": round(time_to_load, 2)}))
 
+        for stage, seconds in (stage_times or {}).items():
+            # "{stage}: {time}s"
+            self.layout.addWidget(TLabel(STATS_PANEL_KEYS[4],
+                                     self,
+                                     context="Stats Panel",
+                                     format_args={"stage": stage, "time": round(seconds, 2)}))
+
         if entity_dict:
             self.layout.addWidget(TLabel(STATS_PANEL_KEYS[3],
                                          self,
                                          context="Stats Panel",
                                          format_args={"count": len(entity_dict)}))
 
-            # Add the list of entity types
-            for ifc_type, count in sorted(entity_dict.items()):
-                label = ClickableLabel(f"{ifc_type}: {count}")
+            # Add the list of entity types with the number of entities and the size of their step lines
+            for ifc_type, (count, size) in sorted(entity_dict.items()):
+                label = ClickableLabel(f"{ifc_type}: {count} ({format_bytes(size)})")
                 label.clicked.connect(self.on_label_clicked)
                 self.layout.addWidget(label)
 